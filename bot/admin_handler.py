@@ -1,7 +1,12 @@
+import asyncio
+import json
 import os
+import tempfile
+import time
 from enum import Enum
 
-from db_handler import DBHandler, Quote
+from db_handler import DBHandler, Quote, QuoteWithId, purge_filter
+from qdrant_client import models
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.ext import (
     CommandHandler,
@@ -10,24 +15,142 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from utils import chunks, progress_bar
+from utils import (
+    chunks,
+    epoch_to_rfc3339,
+    escape_legacy_markup,
+    progress_bar,
+    rfc3339_to_epoch,
+)
 
-ACTION, BACKUP, RECEIVE_DUMP, CONFIRM_RESTORE = range(4)
+(
+    ACTION,
+    BACKUP,
+    RECEIVE_DUMP,
+    CONFIRM_RESTORE,
+    RECEIVE_SNAPSHOT,
+    CONFIRM_SNAPSHOT_RESTORE,
+    RECEIVE_PURGE_CRITERIA,
+    CONFIRM_PURGE,
+) = range(8)
 
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 
 RESTORE_CHUNK_SIZE = 200
 
+BACKUP_STATE_PATH = "./backup_state.json"
+
+# Bots can send files up to 50 MB, but only download files up to 20 MB
+TELEGRAM_UPLOAD_LIMIT_BYTES = 50 * 1024 * 1024
+TELEGRAM_DOWNLOAD_LIMIT_BYTES = 20 * 1024 * 1024
+
+# Candidate sizes for EMBEDDING_DIMENSIONS that are compared by "Evaluate dimensions"
+EVALUATION_DIMENSIONS = [32, 64, 96, 128, 192, 256]
+
+PURGE_CRITERIA_HELP = (
+    "Send me what to delete, criteria can be combined:\n"
+    "group <chat_id> - all quotes from a group\n"
+    "user <user_id> - all quotes of a user\n"
+    "older <days> - all quotes posted more than that many days ago"
+)
+
+
+# Parses e.g. "group -100123 older 365" into a filter
+def parse_purge_criteria(text: str) -> models.Filter:
+    words = text.split()
+    if len(words) == 0 or len(words) % 2 != 0:
+        raise ValueError("Criteria come in pairs of a name and a value")
+
+    criteria = {}
+    for name, value in zip(words[::2], words[1::2]):
+        if name not in ("group", "user", "older"):
+            raise ValueError(f"Unknown criterion {name}")
+        number = int(value)
+        if name == "group":
+            # Group chat ids are negative
+            if number == 0:
+                raise ValueError("A group id can't be 0")
+            criteria["group_id"] = number
+        elif name == "user":
+            if number <= 0:
+                raise ValueError("A user id has to be positive")
+            criteria["account_id"] = number
+        elif name == "older":
+            # Anything else would match quotes from the future, so everything
+            if number <= 0:
+                raise ValueError("The number of days has to be positive")
+            criteria["posted_before"] = int(time.time()) - number * 24 * 60 * 60
+    return purge_filter(**criteria)
+
+
+# First line of an incremental dump, followed by a tab and the time it covers changes since
+INCREMENTAL_DUMP_HEADER = "#incremental"
+
 
 class Trigger(Enum):
     BACKUP = "Backup"
+    INCREMENTAL_BACKUP = "Incremental backup"
+    SNAPSHOT = "Snapshot"
     RESTORE = "Restore"
+    RESTORE_SNAPSHOT = "Restore snapshot"
+    EVALUATE_DIMENSIONS = "Evaluate dimensions"
+    PURGE = "Purge"
     CONFIRM_RESTORE = "YES!"
     CANCEL_RESTORE = "No"
 
 
+def load_last_backup_time() -> float | None:
+    if not os.path.isfile(BACKUP_STATE_PATH):
+        return None
+    with open(BACKUP_STATE_PATH) as state_file:
+        return json.load(state_file).get("last_backup")
+
+
+def store_last_backup_time(timestamp: float):
+    with open(BACKUP_STATE_PATH, "w") as state_file:
+        json.dump({"last_backup": timestamp}, state_file)
+
+
+def to_dump_line(quote: QuoteWithId) -> str:
+    return "\t".join([str(quote.id), quote.to_tsv(), str(quote.times_quoted)])
+
+
+# Accepts the current format (id first, times quoted last), dumps without times quoted
+# and old dumps without ids, whose text predates escaping
+def parse_dump_line(line: str) -> Quote | None:
+    values = line.split("\t")
+    times_quoted = 0
+    if len(values) == 8:
+        quote_id, times_quoted, values = values[0], int(values[7]), values[1:7]
+        quote_text = values[2]
+    elif len(values) == 7:
+        quote_id, values = values[0], values[1:]
+        quote_text = values[2]
+    elif len(values) == 6:
+        quote_id = None
+        quote_text = escape_legacy_markup(values[2])
+    else:
+        return None
+
+    fields = dict(
+        group_id=int(values[0]),
+        message_id=int(values[1]),
+        quote_text=quote_text,
+        account_id=int(values[3]),
+        post_date=rfc3339_to_epoch(values[4]),
+        last_quoted=rfc3339_to_epoch(values[5]),
+    )
+    if quote_id is None:
+        return Quote(**fields)
+    return QuoteWithId(id=quote_id, times_quoted=times_quoted, **fields)
+
+
 def get_admin_handler(db_handler: DBHandler):
     backup_unconfirmed: list[Quote] = []
+    # Whether the pending dump is incremental and has to be merged instead of replacing the DB
+    backup_is_incremental: list[bool] = [False]
+    snapshot_unconfirmed: list[bytearray] = []
+    purge_unconfirmed: list[models.Filter] = []
 
     async def admin_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         chat_id = update.effective_chat.id
@@ -38,12 +161,22 @@ def get_admin_handler(db_handler: DBHandler):
             )
             return None
 
-        reply_keyboard = [[Trigger.BACKUP.value, Trigger.RESTORE.value]]
+        reply_keyboard = [
+            [
+                Trigger.BACKUP.value,
+                Trigger.INCREMENTAL_BACKUP.value,
+                Trigger.SNAPSHOT.value,
+            ],
+            [Trigger.RESTORE.value, Trigger.RESTORE_SNAPSHOT.value],
+            [Trigger.EVALUATE_DIMENSIONS.value, Trigger.PURGE.value],
+        ]
         await update.message.reply_text(
             "Welcome to the QuoBo admin panel.\n"
             "Send /cancel to stop talking to me.\n"
             "What would you like to do?\n\n"
-            f'(Reply with "{Trigger.BACKUP.value}" or "{Trigger.RESTORE.value}")',
+            "(Reply with one of: "
+            + ", ".join(f'"{x}"' for row in reply_keyboard for x in row)
+            + ")",
             reply_markup=ReplyKeyboardMarkup(
                 reply_keyboard,
                 one_time_keyboard=True,
@@ -65,18 +198,104 @@ def get_admin_handler(db_handler: DBHandler):
         trigger = update.message.text
         if trigger == Trigger.BACKUP.value:
             await update.message.reply_text("Alright, preparing dump now.")
-            quotes = db_handler.get_all_entries()
-            dump = "\n".join([quote.to_tsv() for quote in quotes])
+            backup_start = time.time()
+            quotes = await asyncio.to_thread(db_handler.get_all_entries)
+            dump = "\n".join([to_dump_line(quote) for quote in quotes])
             await context.bot.send_document(
                 update.message.chat_id,
                 dump.encode("utf-8"),
                 filename="dump.tsv",
             )
+            store_last_backup_time(backup_start)
+            return ConversationHandler.END
+
+        elif trigger == Trigger.INCREMENTAL_BACKUP.value:
+            last_backup = load_last_backup_time()
+            if last_backup is None:
+                await update.message.reply_text(
+                    "There is no previous backup to build on. Please make a full backup first.",
+                    reply_markup=ReplyKeyboardRemove(),
+                )
+                return ConversationHandler.END
+
+            await update.message.reply_text("Alright, collecting changes now.")
+            backup_start = time.time()
+            quotes = await asyncio.to_thread(
+                db_handler.get_entries_modified_since, last_backup
+            )
+            since = epoch_to_rfc3339(int(last_backup))
+            dump = "\n".join(
+                [f"{INCREMENTAL_DUMP_HEADER}\t{since}"]
+                + [to_dump_line(quote) for quote in quotes]
+            )
+            await context.bot.send_document(
+                update.message.chat_id,
+                dump.encode("utf-8"),
+                filename="incremental_dump.tsv",
+                caption=f"{len(quotes)} quotes changed since {since}.\n"
+                "Deleted quotes are only covered by full backups.",
+            )
+            store_last_backup_time(backup_start)
             return ConversationHandler.END
 
+        elif trigger == Trigger.SNAPSHOT.value:
+            await update.message.reply_text("Alright, creating snapshot now.")
+            with tempfile.TemporaryFile() as snapshot_file:
+                await asyncio.to_thread(db_handler.download_snapshot, snapshot_file)
+                snapshot_size = snapshot_file.tell()
+                if snapshot_size > TELEGRAM_UPLOAD_LIMIT_BYTES:
+                    await update.message.reply_text(
+                        f"The snapshot has {snapshot_size / 1024 / 1024:.1f} MB, but bots "
+                        f"can only send {TELEGRAM_UPLOAD_LIMIT_BYTES // 1024 // 1024} MB. "
+                        "Please use Backup instead or copy the snapshot from the Qdrant "
+                        "server directly."
+                    )
+                    return ConversationHandler.END
+                snapshot_file.seek(0)
+                await context.bot.send_document(
+                    update.message.chat_id,
+                    snapshot_file,
+                    filename="Quote.snapshot",
+                )
+            return ConversationHandler.END
+
+        elif trigger == Trigger.EVALUATE_DIMENSIONS.value:
+            await update.message.reply_text(
+                "Alright, comparing reduced embeddings to the full ones.",
+                reply_markup=ReplyKeyboardRemove(),
+            )
+
+            def evaluate_dimensions() -> dict[int, float]:
+                quote_texts = [x.quote_text for x in db_handler.get_all_entries()]
+                return db_handler.text_embedder.evaluate_reduction(
+                    quote_texts, EVALUATION_DIMENSIONS
+                )
+
+            # Embedding thousands of quotes takes a while, keep the bot responsive
+            recalls = await asyncio.to_thread(evaluate_dimensions)
+            if len(recalls) == 0:
+                await update.message.reply_text("Not enough quotes to evaluate.")
+                return ConversationHandler.END
+
+            await update.message.reply_text(
+                f"Recall@5 against {db_handler.text_embedder.full_dimensions()} dimensions:\n"
+                + "\n".join(f"{k}: {v:.1%}" for k, v in recalls.items())
+            )
+            return ConversationHandler.END
+
+        elif trigger == Trigger.PURGE.value:
+            await update.message.reply_text(
+                PURGE_CRITERIA_HELP, reply_markup=ReplyKeyboardRemove()
+            )
+            return RECEIVE_PURGE_CRITERIA
+
         elif trigger == Trigger.RESTORE.value:
             await update.message.reply_text("Please send me the dump.")
             return RECEIVE_DUMP
+
+        elif trigger == Trigger.RESTORE_SNAPSHOT.value:
+            await update.message.reply_text("Please send me the snapshot.")
+            return RECEIVE_SNAPSHOT
         else:
             await update.message.reply_text("Invalid action. Please try again.")
             return ACTION
@@ -87,27 +306,28 @@ def get_admin_handler(db_handler: DBHandler):
             attachement = await update.message.document.get_file()
             dumpfile = await attachement.download_as_bytearray()
             dumpfile_as_str = dumpfile.decode("utf-8")
-            for entry in dumpfile_as_str.splitlines():
-                values = entry.split("\t")
-                if len(values) != 6:
+            entries = dumpfile_as_str.splitlines()
+            backup_is_incremental[0] = len(entries) > 0 and entries[0].startswith(
+                INCREMENTAL_DUMP_HEADER
+            )
+            for entry in entries:
+                quote = parse_dump_line(entry)
+                if quote is None:
                     continue
-                quote = Quote(
-                    group_id=values[0],
-                    message_id=int(values[1]),
-                    quote_text=values[2],
-                    account_id=int(values[3]),
-                    post_date=values[4],
-                    last_quoted=values[5],
-                )
                 backup_unconfirmed.append(quote)
         except:
             await update.message.reply_text("Invalid dump file. Please try again.")
             return RECEIVE_DUMP
 
+        if backup_is_incremental[0]:
+            restore_warning = "They will be merged into the current database."
+        else:
+            restore_warning = "The current database will be overwritten!"
+
         reply_keyboard = [[Trigger.CONFIRM_RESTORE.value, Trigger.CANCEL_RESTORE.value]]
         await update.message.reply_text(
             f"Found {len(backup_unconfirmed)} quotes. Are you sure you want to restore them?\n"
-            "The current database will be overwritten!\n\n"
+            f"{restore_warning}\n\n"
             f'(Reply with "{Trigger.CONFIRM_RESTORE.value}" or "{Trigger.CANCEL_RESTORE.value}")',
             reply_markup=ReplyKeyboardMarkup(
                 reply_keyboard,
@@ -126,7 +346,8 @@ def get_admin_handler(db_handler: DBHandler):
 
         dump = backup_unconfirmed.copy()
 
-        db_handler.clear_db()
+        if not backup_is_incremental[0]:
+            await asyncio.to_thread(db_handler.clear_db)
         chunked_backup = chunks(dump, RESTORE_CHUNK_SIZE)
 
         progress_info_message = await context.bot.send_message(
@@ -135,7 +356,7 @@ def get_admin_handler(db_handler: DBHandler):
         )
 
         for ind, chunk in enumerate(chunked_backup):
-            db_handler.save_quotes(chunk)
+            await asyncio.to_thread(db_handler.save_quotes, chunk)
             await progress_info_message.edit_text(
                 progress_bar(
                     message="Restoring...",
@@ -144,22 +365,135 @@ def get_admin_handler(db_handler: DBHandler):
                 )
             )
 
+        # Merged quotes may overwrite existing ones, which the incremental caches can't tell
+        if backup_is_incremental[0]:
+            await asyncio.to_thread(db_handler.reset_caches)
+
         await progress_info_message.edit_text(f"Done!\nRestored {len(dump)} quotes.")
 
         return ConversationHandler.END
 
+    async def receive_snapshot(
+        update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> int:
+        snapshot_unconfirmed.clear()
+        document = update.message.document
+        if document and (document.file_size or 0) > TELEGRAM_DOWNLOAD_LIMIT_BYTES:
+            await update.message.reply_text(
+                f"Bots can only download files up to "
+                f"{TELEGRAM_DOWNLOAD_LIMIT_BYTES // 1024 // 1024} MB. Please restore "
+                "larger snapshots through the Qdrant API directly."
+            )
+            return ConversationHandler.END
+
+        try:
+            attachement = await update.message.document.get_file()
+            snapshot_unconfirmed.append(await attachement.download_as_bytearray())
+        except:
+            await update.message.reply_text("Invalid snapshot file. Please try again.")
+            return RECEIVE_SNAPSHOT
+
+        reply_keyboard = [[Trigger.CONFIRM_RESTORE.value, Trigger.CANCEL_RESTORE.value]]
+        await update.message.reply_text(
+            "Are you sure you want to restore this snapshot?\n"
+            "The current database will be overwritten!\n\n"
+            f'(Reply with "{Trigger.CONFIRM_RESTORE.value}" or "{Trigger.CANCEL_RESTORE.value}")',
+            reply_markup=ReplyKeyboardMarkup(
+                reply_keyboard,
+                one_time_keyboard=True,
+                input_field_placeholder="Delete DB and restore from snapshot?",
+            ),
+        )
+        return CONFIRM_SNAPSHOT_RESTORE
+
+    async def confirm_snapshot_restore(
+        update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> int:
+        if update.message.text != Trigger.CONFIRM_RESTORE.value:
+            await update.message.reply_text("Aborting.")
+            return ConversationHandler.END
+
+        await update.message.reply_text(
+            "Restoring snapshot...", reply_markup=ReplyKeyboardRemove()
+        )
+        try:
+            await asyncio.to_thread(
+                db_handler.restore_snapshot, bytes(snapshot_unconfirmed[0])
+            )
+        except Exception as e:
+            await update.message.reply_text(f"Restoring the snapshot failed: {e}")
+            return ConversationHandler.END
+        finally:
+            snapshot_unconfirmed.clear()
+
+        # Snapshots may predate the current schema, so make sure indexes are in place
+        await asyncio.to_thread(db_handler.setup_schema)
+        await asyncio.to_thread(db_handler.reset_caches)
+        await update.message.reply_text("Done!\nSnapshot restored.")
+
+        return ConversationHandler.END
+
+    async def receive_purge_criteria(
+        update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> int:
+        purge_unconfirmed.clear()
+        try:
+            delete_filter = parse_purge_criteria(update.message.text)
+        except ValueError as e:
+            await update.message.reply_text(f"{e}\n\n{PURGE_CRITERIA_HELP}")
+            return RECEIVE_PURGE_CRITERIA
+
+        matching = await asyncio.to_thread(db_handler.count_quotes, delete_filter)
+        if matching == 0:
+            await update.message.reply_text("No quotes match, nothing to do.")
+            return ConversationHandler.END
+        purge_unconfirmed.append(delete_filter)
+
+        reply_keyboard = [[Trigger.CONFIRM_RESTORE.value, Trigger.CANCEL_RESTORE.value]]
+        await update.message.reply_text(
+            f"{matching} quotes match. Are you sure you want to delete them?\n\n"
+            f'(Reply with "{Trigger.CONFIRM_RESTORE.value}" or "{Trigger.CANCEL_RESTORE.value}")',
+            reply_markup=ReplyKeyboardMarkup(
+                reply_keyboard,
+                one_time_keyboard=True,
+                input_field_placeholder="Delete the matching quotes?",
+            ),
+        )
+        return CONFIRM_PURGE
+
+    async def confirm_purge(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        if update.message.text != Trigger.CONFIRM_RESTORE.value:
+            await update.message.reply_text("Aborting.")
+            return ConversationHandler.END
+
+        await update.message.reply_text(
+            "Deleting...", reply_markup=ReplyKeyboardRemove()
+        )
+        # Runs in batches with pauses, so keep the bot responsive meanwhile
+        result = await asyncio.to_thread(db_handler.purge_quotes, purge_unconfirmed[0])
+        purge_unconfirmed.clear()
+        await update.message.reply_text(
+            f"Done!\nRemoved {result.removed} quotes in {result.seconds:.1f}s."
+        )
+
+        return ConversationHandler.END
+
     admin_handler = ConversationHandler(
         entry_points=[CommandHandler("admin_control", admin_control)],
         states={
             ACTION: [
                 MessageHandler(
                     filters.Regex(
-                        f"^({Trigger.BACKUP.value}|{Trigger.RESTORE.value})$"
+                        f"^({Trigger.BACKUP.value}|{Trigger.INCREMENTAL_BACKUP.value}|"
+                        f"{Trigger.SNAPSHOT.value}|{Trigger.RESTORE.value}|"
+                        f"{Trigger.RESTORE_SNAPSHOT.value}|{Trigger.EVALUATE_DIMENSIONS.value}|"
+                        f"{Trigger.PURGE.value})$"
                     ),
                     action_chosen,
                 )
             ],
             RECEIVE_DUMP: [MessageHandler(filters.ATTACHMENT, receive_dump)],
+            RECEIVE_SNAPSHOT: [MessageHandler(filters.ATTACHMENT, receive_snapshot)],
             CONFIRM_RESTORE: [
                 MessageHandler(
                     filters.Regex(
@@ -168,6 +502,25 @@ def get_admin_handler(db_handler: DBHandler):
                     confirm_restore,
                 )
             ],
+            CONFIRM_SNAPSHOT_RESTORE: [
+                MessageHandler(
+                    filters.Regex(
+                        f"^({Trigger.CONFIRM_RESTORE.value}|{Trigger.CANCEL_RESTORE.value})$"
+                    ),
+                    confirm_snapshot_restore,
+                )
+            ],
+            RECEIVE_PURGE_CRITERIA: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_purge_criteria)
+            ],
+            CONFIRM_PURGE: [
+                MessageHandler(
+                    filters.Regex(
+                        f"^({Trigger.CONFIRM_RESTORE.value}|{Trigger.CANCEL_RESTORE.value})$"
+                    ),
+                    confirm_purge,
+                )
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
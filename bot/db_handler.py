@@ -1,44 +1,156 @@
 import random
+import threading
+import time
 import uuid
 from dataclasses import asdict, dataclass
-from datetime import datetime
+from typing import IO, Iterator
 
+import httpx
+import numpy as np
+from hot_index import DEFAULT_MAX_BYTES, HotVectorIndex, Partition
 from qdrant_client import QdrantClient, models
 from qdrant_client.conversions.common_types import Record
-from text_embedder import TextEmbedder
-from utils import datetime_to_rfc3339
+from qdrant_guard import DBUnavailableError, GuardedClient
+from quote_stats import QuoteStats
+from text_embedder import MAX_CHUNKS, TextEmbedder
+from user_centroids import UserCentroids
+from utils import epoch_to_rfc3339, escape_legacy_markup, rfc3339_to_epoch
 
 
-@dataclass
+# Timestamps are stored as epoch seconds, so they can be used in range filters
+@dataclass(slots=True)
 class Quote:
-    group_id: str
+    group_id: int
     message_id: int
     quote_text: str
     account_id: int
-    post_date: str
-    last_quoted: str
+    post_date: int
+    last_quoted: int
 
+    # Dumps keep human readable timestamps, so old and new dumps share one format
     def to_tsv(self) -> str:
         return "\t".join(
             [
-                self.group_id,
+                str(self.group_id),
                 str(self.message_id),
                 self.quote_text,
                 str(self.account_id),
-                self.post_date,
-                self.last_quoted,
+                epoch_to_rfc3339(self.post_date),
+                epoch_to_rfc3339(self.last_quoted),
             ]
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class QuoteWithId(Quote):
     id: str
+    # How often the bot posted the quote, stored under TIMES_QUOTED_KEY
+    times_quoted: int = 0
+
+
+# Payload key holding the epoch time of the last write to a point, used for incremental backups
+MODIFIED_AT_KEY = "modified_at"
+
+# Payload key counting how often a quote was posted by the bot, used to rebuild the stats
+TIMES_QUOTED_KEY = "times_quoted"
+
+# Payload key holding the revision of the payload layout, see migrate_payload
+SCHEMA_VERSION_KEY = "schema"
+SCHEMA_VERSION = 2
+
+METADATA_KEYS = (MODIFIED_AT_KEY, SCHEMA_VERSION_KEY)
+
+MIGRATION_BATCH_SIZE = 256
+
+# Named vectors holding the chunks of a quote, short quotes only have the first one
+CHUNK_VECTOR_NAMES = [f"chunk_{i}" for i in range(MAX_CHUNKS)]
+
+# Temporary copy of the quotes while the collection is rebuilt, see reembed_collection
+MIGRATION_COLLECTION = "Quote_migration"
+
+# Purges delete this many quotes per request and pause in between, so searches and
+# writes from the chats can run in the meantime
+PURGE_BATCH_SIZE = 256
+PURGE_BATCH_PAUSE_SECONDS = 0.1
+
+# Deferred payload updates are sent at the latest once this many are pending
+MAX_PENDING_PAYLOADS = 32
+
+INDEXED_FIELDS = {
+    MODIFIED_AT_KEY: models.PayloadSchemaType.FLOAT,
+    "group_id": models.PayloadSchemaType.INTEGER,
+    "account_id": models.PayloadSchemaType.INTEGER,
+    "post_date": models.PayloadSchemaType.INTEGER,
+    "last_quoted": models.PayloadSchemaType.INTEGER,
+}
 
 
 # Receives a dict from the database and converts it to a QuoteWithId object
 def parse_db_res(id: str, res: dict) -> QuoteWithId:
-    return QuoteWithId(id=id, **res)
+    fields = {k: v for k, v in res.items() if k not in METADATA_KEYS}
+    return QuoteWithId(id=id, **fields)
+
+
+def to_payload(quote: Quote, modified_at: float) -> dict:
+    payload = asdict(quote)
+    payload.pop("id", None)
+    payload[MODIFIED_AT_KEY] = modified_at
+    payload[SCHEMA_VERSION_KEY] = SCHEMA_VERSION
+    return payload
+
+
+# Converts a payload from the first revision (string group id, RFC3339 timestamps,
+# unescaped text)
+def migrate_payload(payload: dict) -> dict:
+    return {
+        "group_id": int(payload["group_id"]),
+        "quote_text": escape_legacy_markup(payload["quote_text"]),
+        "post_date": rfc3339_to_epoch(payload["post_date"]),
+        "last_quoted": rfc3339_to_epoch(payload["last_quoted"]),
+        SCHEMA_VERSION_KEY: SCHEMA_VERSION,
+    }
+
+
+@dataclass(slots=True)
+class PurgeResult:
+    removed: int
+    seconds: float
+
+
+# Matches all quotes that fulfill every given criterion
+def purge_filter(
+    group_id: int | None = None,
+    account_id: int | None = None,
+    posted_before: int | None = None,
+) -> models.Filter:
+    conditions = []
+    if group_id is not None:
+        conditions.append(
+            models.FieldCondition(
+                key="group_id", match=models.MatchValue(value=group_id)
+            )
+        )
+    if account_id is not None:
+        conditions.append(
+            models.FieldCondition(
+                key="account_id", match=models.MatchValue(value=account_id)
+            )
+        )
+    if posted_before is not None:
+        conditions.append(
+            models.FieldCondition(key="post_date", range=models.Range(lt=posted_before))
+        )
+    if len(conditions) == 0:
+        raise ValueError("Refusing to purge without any criteria")
+    return models.Filter(must=conditions)
+
+
+# Stacks the named chunk vectors of a point into a (chunks, dimension) matrix
+def chunk_vectors(vectors: dict[str, list[float]]) -> np.ndarray:
+    return np.array(
+        [vectors[name] for name in CHUNK_VECTOR_NAMES if name in vectors],
+        dtype=np.float32,
+    )
 
 
 def distance_to_weight(distance: float) -> float:
@@ -46,36 +158,234 @@ def distance_to_weight(distance: float) -> float:
 
 
 class DBHandler:
-    def __init__(self):
-        self.client = QdrantClient("localhost", port=6333)
-        self.text_embedder = TextEmbedder()
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6333,
+        grpc_port: int = 6334,
+        prefer_grpc: bool = False,
+        hot_index_max_bytes: int = DEFAULT_MAX_BYTES,
+        embedding_dimensions: int | None = None,
+    ):
+        self.host = host
+        self.port = port
+        # gRPC avoids JSON encoding the vectors, REST is still used for snapshots
+        self.client = GuardedClient(
+            lambda timeout: QdrantClient(
+                host=host,
+                port=port,
+                grpc_port=grpc_port,
+                prefer_grpc=prefer_grpc,
+                timeout=timeout,
+            )
+        )
+        # Payload updates that are not needed right away, sent together by flush_payload_updates
+        self.pending_payloads: dict[str, dict] = {}
+        self.pending_payloads_lock = threading.Lock()
+        self.hot_index = HotVectorIndex(max_bytes=hot_index_max_bytes)
+        self.text_embedder = TextEmbedder(reduced_dimensions=embedding_dimensions)
+        self.stats = QuoteStats()
+        self.centroids = UserCentroids()
         self.setup_schema()
+        quote_count = self.count_quotes()
+        if not self.stats.load(quote_count):
+            self.rebuild_stats()
+        if not self.centroids.load(self.text_embedder.dimensions(), quote_count):
+            self.rebuild_centroids()
+
+    # False while Qdrant calls fail fast, quotes of cached users are still served
+    def is_available(self) -> bool:
+        return not self.client.breaker.is_open
+
+    # Closes the circuit breaker again once Qdrant responds
+    def probe_health(self) -> bool:
+        return self.client.probe()
 
     def setup_schema(self):
-        present_collections = self.client.get_collections()
-        quote_collection = next(
-            (x for x in present_collections.collections if x.name == "Quote"), None
+        present_collections = [
+            x.name for x in self.client.get_collections().collections
+        ]
+        if self.text_embedder.needs_projection():
+            self._fit_projection(present_collections)
+        if MIGRATION_COLLECTION in present_collections:
+            self._resume_reembedding("Quote" in present_collections)
+        elif "Quote" not in present_collections:
+            self.create_collection()
+        else:
+            self.migrate_payloads()
+            if not self._vectors_up_to_date():
+                self.reembed_collection()
+
+        # Creating an existing index is a no-op, so this also covers older collections
+        for field_name, field_schema in INDEXED_FIELDS.items():
+            self.client.create_payload_index(
+                collection_name="Quote",
+                field_name=field_name,
+                field_schema=field_schema,
+            )
+
+    # Rewrites all payloads that predate the current schema, one batch at a time
+    def migrate_payloads(self):
+        outdated_filter = models.Filter(
+            must_not=[
+                models.FieldCondition(
+                    key=SCHEMA_VERSION_KEY,
+                    match=models.MatchValue(value=SCHEMA_VERSION),
+                )
+            ]
         )
-        if quote_collection:
-            return
+        migrated = 0
+        offset = "initial"
+        while offset:
+            curr_batch = self.client.scroll(
+                collection_name="Quote",
+                scroll_filter=outdated_filter,
+                with_payload=True,
+                limit=MIGRATION_BATCH_SIZE,
+                offset=None if offset == "initial" else offset,
+            )
+            offset = curr_batch[1]
+            if len(curr_batch[0]) == 0:
+                continue
+
+            self.client.batch_update_points(
+                collection_name="Quote",
+                update_operations=[
+                    models.SetPayloadOperation(
+                        set_payload=models.SetPayload(
+                            payload=migrate_payload(x.payload), points=[x.id]
+                        )
+                    )
+                    for x in curr_batch[0]
+                ],
+            )
+            migrated += len(curr_batch[0])
+
+        if migrated > 0:
+            print(f"Migrated {migrated} quotes to schema version {SCHEMA_VERSION}")
 
-        vector_size = self.text_embedder.model.get_sentence_embedding_dimension()
+    def create_collection(self):
+        vector_size = self.text_embedder.dimensions()
         self.client.create_collection(
             collection_name="Quote",
-            vectors_config=models.VectorParams(
-                size=vector_size, distance=models.Distance.COSINE, on_disk=True
-            ),
+            vectors_config={
+                name: models.VectorParams(
+                    size=vector_size, distance=models.Distance.COSINE, on_disk=True
+                )
+                for name in CHUNK_VECTOR_NAMES
+            },
             hnsw_config={
                 "m": 32,
                 "ef_construct": 200,
             },
         )
 
-    def simple_search(self, query: str) -> QuoteWithId:
-        query_embedding = self.text_embedder.embed([query])[0]
+    # Fits the dimensionality reduction on the stored quotes. A changed dimension count
+    # makes _vectors_up_to_date fail afterwards, which re-embeds the collection.
+    def _fit_projection(self, present_collections: list[str]):
+        if MIGRATION_COLLECTION in present_collections:
+            source_collection = MIGRATION_COLLECTION
+        elif "Quote" in present_collections:
+            source_collection = "Quote"
+        else:
+            return
+
+        quote_texts = [
+            x.payload["quote_text"]
+            for curr_batch in self._iter_batches(source_collection)
+            for x in curr_batch
+        ]
+        self.text_embedder.fit_projection(quote_texts)
+
+    def _vectors_up_to_date(self) -> bool:
+        vectors = self.client.get_collection("Quote").config.params.vectors
+        vector_size = self.text_embedder.dimensions()
+        return (
+            isinstance(vectors, dict)
+            and set(vectors.keys()) == set(CHUNK_VECTOR_NAMES)
+            and all(x.size == vector_size for x in vectors.values())
+        )
 
-        found_quote = self.client.search(
+    # Recreates the collection with the current vector layout and embeds every quote again.
+    # The quotes are parked in a temporary collection meanwhile, so an interrupted run
+    # can be resumed on the next start.
+    def reembed_collection(self):
+        print("Vector layout changed, re-embedding all quotes")
+        self.client.recreate_collection(
+            collection_name=MIGRATION_COLLECTION,
+            vectors_config=self.client.get_collection("Quote").config.params.vectors,
+        )
+        for curr_batch in self._iter_batches("Quote", with_vectors=True):
+            self.client.upsert(
+                collection_name=MIGRATION_COLLECTION,
+                points=[
+                    models.PointStruct(id=x.id, vector=x.vector, payload=x.payload)
+                    for x in curr_batch
+                ],
+            )
+        self._refill_from_migration(drop_quote=True)
+
+    def _resume_reembedding(self, quote_exists: bool):
+        # The original is only replaced after the copy is complete, so start over if it
+        # still has the old layout
+        if quote_exists and not self._vectors_up_to_date():
+            self.client.delete_collection(collection_name=MIGRATION_COLLECTION)
+            self.reembed_collection()
+        else:
+            self._refill_from_migration(drop_quote=quote_exists)
+
+    def _refill_from_migration(self, drop_quote: bool):
+        if drop_quote:
+            self.client.delete_collection(collection_name="Quote")
+        self.create_collection()
+
+        reembedded = 0
+        for curr_batch in self._iter_batches(MIGRATION_COLLECTION):
+            self._upsert_points(
+                [x.id for x in curr_batch], [x.payload for x in curr_batch]
+            )
+            reembedded += len(curr_batch)
+        self.client.delete_collection(collection_name=MIGRATION_COLLECTION)
+        self.centroids.discard()
+        print(f"Re-embedded {reembedded} quotes")
+
+    # Each chunk has its own named vector, a quote scores as its best matching chunk
+    def _max_sim_search(
+        self,
+        query_embedding: np.ndarray,
+        query_filter: models.Filter,
+        hnsw_ef: int,
+        limit: int,
+    ) -> list[models.ScoredPoint]:
+        self.flush_payload_updates()
+        # Search requests are validated as plain lists
+        query_vector = query_embedding.tolist()
+        results = self.client.search_batch(
             collection_name="Quote",
+            requests=[
+                models.SearchRequest(
+                    vector=models.NamedVector(name=name, vector=query_vector),
+                    filter=query_filter,
+                    params=models.SearchParams(hnsw_ef=hnsw_ef, exact=False),
+                    limit=limit,
+                    with_payload=True,
+                )
+                for name in CHUNK_VECTOR_NAMES
+            ],
+        )
+
+        best_points: dict[str, models.ScoredPoint] = {}
+        for found_points in results:
+            for x in found_points:
+                if x.id not in best_points or x.score > best_points[x.id].score:
+                    best_points[x.id] = x
+        return sorted(best_points.values(), key=lambda x: x.score, reverse=True)[:limit]
+
+    def simple_search(self, query: str) -> QuoteWithId | None:
+        query_embedding = self.text_embedder.embed([query])[0]
+
+        found_quote_points = self._max_sim_search(
+            query_embedding,
             query_filter=models.Filter(
                 must_not=[
                     models.FieldCondition(
@@ -84,60 +394,140 @@ class DBHandler:
                     )
                 ],
             ),
-            search_params=models.SearchParams(hnsw_ef=32, exact=False),
-            query_vector=query_embedding.tolist(),
+            hnsw_ef=32,
             limit=1,
-        )[0]
+        )
 
-        return parse_db_res(found_quote.id, found_quote.payload)
+        if len(found_quote_points) == 0:
+            return None
+
+        return parse_db_res(found_quote_points[0].id, found_quote_points[0].payload)
 
     def clear_db(self):
+        with self.pending_payloads_lock:
+            self.pending_payloads = {}
         self.client.delete_collection(collection_name="Quote")
         self.setup_schema()
+        self.stats.clear()
+        self.hot_index.clear()
+        self.centroids.rebuild([])
 
-    def get_all_entries(self) -> list[QuoteWithId]:
-        out: list[Quote] = []
+    def _iter_batches(
+        self,
+        collection_name: str,
+        scroll_filter: models.Filter | None = None,
+        with_vectors: bool = False,
+    ) -> Iterator[list[Record]]:
         offset = "initial"
         while offset:
             curr_batch = self.client.scroll(
-                collection_name="Quote",
+                collection_name=collection_name,
+                scroll_filter=scroll_filter,
                 with_payload=True,
+                with_vectors=with_vectors,
+                limit=MIGRATION_BATCH_SIZE,
                 offset=None if offset == "initial" else offset,
             )
             offset = curr_batch[1]
-            out.extend([parse_db_res(x.id, x.payload) for x in curr_batch[0]])
-        return out
+            yield curr_batch[0]
+
+    def iter_points(
+        self, scroll_filter: models.Filter | None = None
+    ) -> Iterator[Record]:
+        self.flush_payload_updates()
+        for curr_batch in self._iter_batches("Quote", scroll_filter):
+            yield from curr_batch
+
+    def get_all_entries(
+        self, scroll_filter: models.Filter | None = None
+    ) -> list[QuoteWithId]:
+        return [parse_db_res(x.id, x.payload) for x in self.iter_points(scroll_filter)]
+
+    def rebuild_stats(self):
+        self.stats.rebuild(
+            (
+                x.payload["group_id"],
+                str(x.id),
+                x.payload["account_id"],
+                x.payload["post_date"],
+                x.payload.get(TIMES_QUOTED_KEY, 0),
+            )
+            for x in self.iter_points()
+        )
+
+    # Call after the collection was changed behind the handler's back, e.g. by a restore
+    def reset_caches(self):
+        self.rebuild_stats()
+        self.rebuild_centroids()
+        self.hot_index.clear()
+
+    def rebuild_centroids(self):
+        self.flush_payload_updates()
+        self.centroids.rebuild(
+            (x.payload["account_id"], chunk_vectors(x.vector))
+            for curr_batch in self._iter_batches("Quote", with_vectors=True)
+            for x in curr_batch
+        )
+
+    # Orders candidates by how closely their quotes resemble text, closest first
+    def similar_users(self, text: str, candidates: list[int], k: int) -> list[int]:
+        query_embedding = self.text_embedder.embed([text])[0]
+        return self.centroids.nearest(query_embedding, candidates, k)
+
+    def get_quotes_by_ids(self, quote_ids: list[str]) -> list[QuoteWithId]:
+        self.flush_payload_updates()
+        found_quote_points = self.client.retrieve(
+            collection_name="Quote", ids=quote_ids, with_payload=True
+        )
+        return [parse_db_res(x.id, x.payload) for x in found_quote_points]
+
+    def get_entries_modified_since(self, since: float) -> list[QuoteWithId]:
+        return self.get_all_entries(
+            scroll_filter=models.Filter(
+                must=[
+                    models.FieldCondition(
+                        key=MODIFIED_AT_KEY,
+                        range=models.Range(gte=since),
+                    )
+                ]
+            )
+        )
 
     def get_all_quoted_user_ids(self) -> list[int]:
-        all_quotes = self.get_all_entries()
-        all_user_ids = [x.account_id for x in all_quotes]
-        return list(set(all_user_ids))
+        return list(self.stats.quoted_user_ids())
+
+    # Looks up many (account_id, quote_text) pairs with a single scroll
+    def find_quotes(
+        self, keys: list[tuple[int, str]]
+    ) -> dict[tuple[int, str], QuoteWithId]:
+        unique_keys = list(set(keys))
+        if len(unique_keys) == 0:
+            return {}
 
-    def find_quote(self, account_id: int, quote_text: str) -> QuoteWithId | None:
         found_quote_points = self.client.scroll(
             collection_name="Quote",
             scroll_filter=models.Filter(
-                must=[
-                    models.FieldCondition(
-                        key="quote_text",
-                        match=models.MatchValue(value=quote_text),
-                    ),
-                    models.FieldCondition(
-                        key="account_id",
-                        match=models.MatchValue(value=account_id),
-                    ),
+                should=[
+                    models.Filter(
+                        must=[
+                            models.FieldCondition(
+                                key="quote_text",
+                                match=models.MatchValue(value=quote_text),
+                            ),
+                            models.FieldCondition(
+                                key="account_id",
+                                match=models.MatchValue(value=account_id),
+                            ),
+                        ]
+                    )
+                    for account_id, quote_text in unique_keys
                 ]
             ),
-            limit=1,
+            limit=len(unique_keys),
         )[0]
 
-        if len(found_quote_points) == 0:
-            return None
-
-        existing_quote = parse_db_res(
-            found_quote_points[0].id, found_quote_points[0].payload
-        )
-        return existing_quote
+        found_quotes = [parse_db_res(x.id, x.payload) for x in found_quote_points]
+        return {(x.account_id, x.quote_text): x for x in found_quotes}
 
     def find_quote_by_message_id(self, message_id: int) -> QuoteWithId | None:
         found_quote_points = self.client.scroll(
@@ -162,39 +552,182 @@ class DBHandler:
         return existing_quote
 
     def delete_quote_by_id(self, quote_id: str):
+        self.flush_payload_updates()
+        deleted_points = self.client.retrieve(
+            collection_name="Quote",
+            ids=[quote_id],
+            with_payload=True,
+            with_vectors=True,
+        )
         self.client.delete(
             collection_name="Quote",
             points_selector=models.PointIdsList(
                 points=[quote_id],
             ),
         )
+        self._forget_deleted(deleted_points)
+
+    # Keeps the local caches in line with points that were just deleted
+    def _forget_deleted(self, deleted_points: list[Record]):
+        with self.pending_payloads_lock:
+            for point in deleted_points:
+                self.pending_payloads.pop(point.id, None)
+
+        for point in deleted_points:
+            x = parse_db_res(point.id, point.payload)
+            self.stats.remove_quote(x.group_id, str(x.id), x.account_id, x.post_date)
+            self.hot_index.remove(x.account_id, str(x.id))
+            self.centroids.remove(x.account_id, chunk_vectors(point.vector))
+
+    def count_quotes(self, count_filter: models.Filter | None = None) -> int:
+        return self.client.count(
+            collection_name="Quote", count_filter=count_filter, exact=True
+        ).count
+
+    # Deletes every quote matching delete_filter in bounded batches, then lets Qdrant
+    # optimize the segments that now mostly consist of deleted points
+    def purge_quotes(self, delete_filter: models.Filter) -> PurgeResult:
+        start = time.perf_counter()
+        self.flush_payload_updates()
+
+        removed = 0
+        while True:
+            curr_batch = self.client.scroll(
+                collection_name="Quote",
+                scroll_filter=delete_filter,
+                with_payload=True,
+                with_vectors=True,
+                limit=PURGE_BATCH_SIZE,
+            )[0]
+            if len(curr_batch) == 0:
+                break
+
+            # The filter is checked again server side, in case a point changed meanwhile
+            self.client.delete(
+                collection_name="Quote",
+                points_selector=models.FilterSelector(
+                    filter=models.Filter(
+                        must=[
+                            delete_filter,
+                            models.HasIdCondition(has_id=[x.id for x in curr_batch]),
+                        ]
+                    )
+                ),
+            )
+            # Only what the server side check let through is gone
+            remaining_ids = {
+                str(x.id)
+                for x in self.client.retrieve(
+                    collection_name="Quote",
+                    ids=[x.id for x in curr_batch],
+                    with_payload=False,
+                )
+            }
+            deleted_points = [x for x in curr_batch if str(x.id) not in remaining_ids]
+            self._forget_deleted(deleted_points)
+            removed += len(deleted_points)
+            time.sleep(PURGE_BATCH_PAUSE_SECONDS)
+
+        if removed > 0:
+            # An empty diff just restarts the optimizers
+            self.client.update_collection(
+                collection_name="Quote",
+                optimizers_config=models.OptimizersConfigDiff(),
+            )
+        return PurgeResult(removed=removed, seconds=time.perf_counter() - start)
 
+    # Quotes that already carry an id (e.g. from a backup) keep it, so re-saving them overwrites
     def save_quotes(
         self,
         new_quotes: list[Quote],
-    ):
-        ids = [str(uuid.uuid4()) for _ in new_quotes]
-        payloads = [asdict(x) for x in new_quotes]
-        vectors = [
-            x.tolist()
-            for x in self.text_embedder.embed([x.quote_text for x in new_quotes])
+    ) -> list[QuoteWithId]:
+        modified_at = time.time()
+        ids = [
+            x.id if isinstance(x, QuoteWithId) else str(uuid.uuid4())
+            for x in new_quotes
         ]
+        payloads = [to_payload(x, modified_at) for x in new_quotes]
+        self._keep_times_quoted(
+            [id for x, id in zip(new_quotes, ids) if isinstance(x, QuoteWithId)],
+            dict(zip(ids, payloads)),
+        )
+        embeddings = self._upsert_points(ids, payloads)
+        for x, id, payload, embedding in zip(new_quotes, ids, payloads, embeddings):
+            self.stats.add_quote(
+                x.group_id,
+                id,
+                x.account_id,
+                x.post_date,
+                payload.get(TIMES_QUOTED_KEY, 0),
+            )
+            self.hot_index.add(x.account_id, id, payload, embedding)
+            self.centroids.add(x.account_id, embedding)
+        return [parse_db_res(id, payload) for id, payload in zip(ids, payloads)]
+
+    # Restoring a quote overwrites the point with the same id, which must not lower how
+    # often it was quoted
+    def _keep_times_quoted(self, ids: list[str], payloads: dict[str, dict]):
+        if len(ids) == 0:
+            return
+
+        self.flush_payload_updates()
+        existing_points = self.client.retrieve(
+            collection_name="Quote", ids=ids, with_payload=[TIMES_QUOTED_KEY]
+        )
+        for x in existing_points:
+            payload = payloads[str(x.id)]
+            payload[TIMES_QUOTED_KEY] = max(
+                payload.get(TIMES_QUOTED_KEY, 0), x.payload.get(TIMES_QUOTED_KEY, 0)
+            )
+
+    # Embeds the quote texts of the payloads and writes the points, returns the embeddings
+    def _upsert_points(self, ids: list[str], payloads: list[dict]) -> list[np.ndarray]:
+        embeddings = self.text_embedder.embed_chunked(
+            [x["quote_text"] for x in payloads]
+        )
         self.client.upsert(
             collection_name="Quote",
-            points=models.Batch(
-                ids=ids,
-                payloads=payloads,
-                vectors=vectors,
-            ),
+            points=[
+                models.PointStruct(
+                    id=id,
+                    vector={
+                        name: chunk.tolist()
+                        for name, chunk in zip(CHUNK_VECTOR_NAMES, embedding)
+                    },
+                    payload=payload,
+                )
+                for id, payload, embedding in zip(ids, payloads, embeddings)
+            ],
         )
+        return embeddings
 
     def quote_for_user_by_query(
         self, account_id: int, query: str
     ) -> QuoteWithId | None:
         query_embedding = self.text_embedder.embed([query])[0]
 
-        found_quote_points = self.client.search(
-            collection_name="Quote",
+        partition = self._hot_partition(account_id)
+        if partition is not None:
+            found_quote_points = self.hot_index.search(
+                partition, query_embedding, limit=5, exclude_text=query
+            )
+        else:
+            found_quote_points = self._search_for_user(
+                account_id, query, query_embedding
+            )
+
+        choices = [(x, x.score) for x in found_quote_points]
+
+        print(f"Found {len(choices)} quotes for query '{query}':")
+        print("\n".join([str((x[0].payload["quote_text"], x[1])) for x in choices]))
+
+        return self._choose_quote(choices)
+
+    def _search_for_user(
+        self, account_id: int, query: str, query_embedding: np.ndarray
+    ) -> list[models.ScoredPoint]:
+        return self._max_sim_search(
+            query_embedding,
             query_filter=models.Filter(
                 must=[
                     models.FieldCondition(
@@ -209,19 +742,48 @@ class DBHandler:
                     )
                 ],
             ),
-            search_params=models.SearchParams(hnsw_ef=128, exact=False),
-            query_vector=query_embedding.tolist(),
+            hnsw_ef=128,
             limit=5,
         )
 
-        choices = [(x, x.score) for x in found_quote_points]
+    # Returns the cached quotes of a user, loading them if the user is small enough
+    def _hot_partition(self, account_id: int) -> Partition | None:
+        if not self.hot_index.enabled() or self.hot_index.is_oversized(account_id):
+            return None
 
-        print(f"Found {len(choices)} quotes for query '{query}':")
-        print("\n".join([str((x[0].payload["quote_text"], x[1])) for x in choices]))
+        partition = self.hot_index.get(account_id)
+        if partition is not None:
+            return partition
 
-        return self._choose_quote(choices)
+        generation = self.hot_index.generation(account_id)
+        self.flush_payload_updates()
+        found_quote_points = self.client.scroll(
+            collection_name="Quote",
+            scroll_filter=models.Filter(
+                must=[
+                    models.FieldCondition(
+                        key="account_id",
+                        match=models.MatchValue(value=account_id),
+                    )
+                ]
+            ),
+            with_payload=True,
+            with_vectors=True,
+            limit=self.hot_index.max_partition_size + 1,
+        )[0]
+        self.hot_index.put(account_id, found_quote_points, generation)
+        return self.hot_index.get(account_id)
 
     def pseudo_random_quote_for_user(self, account_id: int) -> QuoteWithId | None:
+        partition = self._hot_partition(account_id)
+        if partition is not None:
+            choices = [
+                [models.Record(id=id, payload=payload), 1]
+                for id, payload in zip(partition.ids, partition.payloads)
+            ]
+            return self._choose_quote(choices)
+
+        self.flush_payload_updates()
         found_quote_points = self.client.scroll(
             collection_name="Quote",
             with_payload=True,
@@ -253,11 +815,128 @@ class DBHandler:
 
         selected_quote = parse_db_res(selected_entry.id, selected_entry.payload)
 
-        self.client.set_payload(
-            collection_name="Quote",
-            payload={
-                "last_quoted": datetime_to_rfc3339(datetime.now().astimezone()),
-            },
-            points=[selected_quote.id],
+        payload_update = {
+            "last_quoted": int(time.time()),
+            TIMES_QUOTED_KEY: selected_entry.payload.get(TIMES_QUOTED_KEY, 0) + 1,
+            MODIFIED_AT_KEY: time.time(),
+        }
+        # Posting the quote doesn't depend on this, so it is sent with the next batch
+        self.defer_payload_update(selected_quote.id, payload_update)
+        self.hot_index.update_payload(
+            selected_quote.account_id, str(selected_quote.id), payload_update
         )
+        self.stats.quote_resurfaced(selected_quote.group_id, str(selected_quote.id))
         return selected_quote
+
+    def defer_payload_update(self, quote_id: str, payload: dict):
+        with self.pending_payloads_lock:
+            self.pending_payloads.setdefault(quote_id, {}).update(payload)
+            pending_count = len(self.pending_payloads)
+        if pending_count >= MAX_PENDING_PAYLOADS:
+            self.flush_payload_updates()
+
+    # Sends all deferred payload updates in a single request.
+    # Called before reads whose results depend on these payloads, so it never raises.
+    # Returns False if the updates are kept for later because Qdrant is unavailable.
+    def flush_payload_updates(self) -> bool:
+        with self.pending_payloads_lock:
+            pending = self.pending_payloads
+            self.pending_payloads = {}
+        if len(pending) == 0:
+            return True
+
+        try:
+            self._send_payload_updates(pending)
+        except DBUnavailableError as e:
+            # Put them back without overwriting anything that was deferred meanwhile
+            with self.pending_payloads_lock:
+                for quote_id, payload in pending.items():
+                    self.pending_payloads[
+                        quote_id
+                    ] = payload | self.pending_payloads.get(quote_id, {})
+            print(f"Keeping {len(pending)} payload updates for later: {e}")
+            return False
+        except Exception as e:
+            # Sending them again would only fail the same way
+            print(f"Dropping {len(pending)} payload updates: {e}")
+        return True
+
+    # Qdrant rejects the whole batch if a single quote doesn't exist anymore, e.g. because
+    # it was deleted meanwhile or isn't part of a restored snapshot. Those are dropped and
+    # the rest is sent again.
+    def _send_payload_updates(self, pending: dict[str, dict]):
+        try:
+            self._set_payloads(pending)
+        except DBUnavailableError:
+            raise
+        except Exception:
+            existing_ids = {
+                str(x.id)
+                for x in self.client.retrieve(
+                    collection_name="Quote", ids=list(pending), with_payload=False
+                )
+            }
+            if len(existing_ids) == len(pending):
+                raise
+            print(
+                f"Dropping {len(pending) - len(existing_ids)} payload updates of "
+                "deleted quotes"
+            )
+            if len(existing_ids) > 0:
+                self._set_payloads(
+                    {k: v for k, v in pending.items() if k in existing_ids}
+                )
+
+    def _set_payloads(self, payloads: dict[str, dict]):
+        self.client.batch_update_points(
+            collection_name="Quote",
+            update_operations=[
+                models.SetPayloadOperation(
+                    set_payload=models.SetPayload(payload=payload, points=[quote_id])
+                )
+                for quote_id, payload in payloads.items()
+            ],
+        )
+
+    def _snapshot_api_url(self) -> str:
+        return f"http://{self.host}:{self.port}/collections/Quote/snapshots"
+
+    # Creates a server side snapshot of the collection and streams it into target
+    def download_snapshot(self, target: IO[bytes]):
+        snapshot = self.client.create_snapshot(collection_name="Quote")
+        try:
+            self.client.run(
+                "download_snapshot",
+                lambda deadline: self._stream_snapshot(snapshot.name, target, deadline),
+            )
+        finally:
+            self.client.delete_snapshot(
+                collection_name="Quote", snapshot_name=snapshot.name
+            )
+
+    # The httpx timeout only limits single reads, the deadline covers the whole transfer
+    def _stream_snapshot(self, snapshot_name: str, target: IO[bytes], deadline: int):
+        give_up_at = time.monotonic() + deadline
+        with httpx.stream(
+            "GET", f"{self._snapshot_api_url()}/{snapshot_name}", timeout=deadline
+        ) as response:
+            response.raise_for_status()
+            for data in response.iter_bytes():
+                if time.monotonic() > give_up_at:
+                    raise TimeoutError(f"Snapshot download took over {deadline}s")
+                target.write(data)
+
+    # Replaces the collection with the contents of an uploaded snapshot
+    def restore_snapshot(self, snapshot: bytes):
+        # Deferred updates may point at quotes the snapshot doesn't contain
+        with self.pending_payloads_lock:
+            self.pending_payloads = {}
+        self.client.run(
+            "upload_snapshot",
+            lambda deadline: httpx.post(
+                f"{self._snapshot_api_url()}/upload",
+                params={"priority": "snapshot"},
+                files={"snapshot": ("Quote.snapshot", snapshot)},
+                timeout=deadline,
+            ).raise_for_status(),
+        )
@@ -0,0 +1,225 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from qdrant_client import models
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Users with more quotes than this are always searched in Qdrant
+MAX_PARTITION_SIZE = 1000
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+@dataclass(slots=True)
+class Partition:
+    ids: list[str]
+    payloads: list[dict]
+    # One normalized row per chunk, so a dot product is the cosine similarity Qdrant
+    # would report
+    vectors: np.ndarray
+    # Index into ids for every row of vectors
+    owners: np.ndarray
+
+    def nbytes(self) -> int:
+        return self.vectors.nbytes
+
+
+# In-process copy of the quotes of recently active users, searched with a single
+# matrix product. Partitions are kept in sync by DBHandler and evicted as a whole,
+# least recently used first, once max_bytes is exceeded.
+class HotVectorIndex:
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_partition_size: int = MAX_PARTITION_SIZE,
+    ):
+        self.max_bytes = max_bytes
+        self.max_partition_size = max_partition_size
+        self.partitions: OrderedDict[int, Partition] = OrderedDict()
+        # Users known to exceed max_partition_size, so they aren't loaded again and again
+        self.oversized: set[int] = set()
+        self.used_bytes = 0
+        # Counts changes per user and calls to clear, so put can tell whether records
+        # loaded meanwhile are still current
+        self.generations: dict[int, int] = {}
+        self.clears = 0
+        self.lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, account_id: int) -> Partition | None:
+        with self.lock:
+            partition = self.partitions.get(account_id)
+            if partition is not None:
+                self.partitions.move_to_end(account_id)
+            return partition
+
+    def is_oversized(self, account_id: int) -> bool:
+        return account_id in self.oversized
+
+    # Take this before loading a user's records and pass it to put
+    def generation(self, account_id: int) -> tuple[int, int]:
+        with self.lock:
+            return self.clears, self.generations.get(account_id, 0)
+
+    def _changed(self, account_id: int):
+        self.generations[account_id] = self.generations.get(account_id, 0) + 1
+
+    # Records loaded while the user's quotes changed may miss that change, those are
+    # discarded and loaded again next time
+    def put(
+        self,
+        account_id: int,
+        records: list[models.Record],
+        generation: tuple[int, int],
+    ):
+        # Without records there is no vector size to build a partition with, users
+        # without quotes are simply looked up in Qdrant
+        if len(records) == 0:
+            return
+        if len(records) > self.max_partition_size:
+            with self.lock:
+                if generation == (self.clears, self.generations.get(account_id, 0)):
+                    self.oversized.add(account_id)
+            return
+
+        # Records carry a dict of named vectors, one per chunk
+        chunks = [list(x.vector.values()) for x in records]
+        vector_size = len(chunks[0][0])
+        partition = Partition(
+            ids=[str(x.id) for x in records],
+            payloads=[x.payload for x in records],
+            vectors=normalize(
+                np.array(
+                    [vector for vectors in chunks for vector in vectors],
+                    dtype=np.float32,
+                ).reshape(-1, vector_size)
+            ),
+            owners=np.repeat(np.arange(len(chunks)), [len(x) for x in chunks]),
+        )
+        with self.lock:
+            if generation != (self.clears, self.generations.get(account_id, 0)):
+                return
+            self._drop(account_id)
+            self.partitions[account_id] = partition
+            self.used_bytes += partition.nbytes()
+            self._evict()
+
+    # Only users that are already cached are updated, the rest is loaded lazily.
+    # vectors holds one row per chunk of the quote.
+    def add(self, account_id: int, quote_id: str, payload: dict, vectors: np.ndarray):
+        with self.lock:
+            self._changed(account_id)
+            partition = self.partitions.get(account_id)
+            if partition is None:
+                return
+            # Overwritten by id, or already part of the records the partition was loaded from
+            self._remove_row(partition, quote_id)
+            if len(partition.ids) >= self.max_partition_size:
+                self._drop(account_id)
+                self.oversized.add(account_id)
+                return
+
+            self.used_bytes -= partition.nbytes()
+            partition.owners = np.concatenate(
+                [partition.owners, np.full(len(vectors), len(partition.ids))]
+            )
+            partition.ids.append(quote_id)
+            partition.payloads.append(payload)
+            partition.vectors = np.vstack(
+                [
+                    partition.vectors.reshape(-1, vectors.shape[-1]),
+                    normalize(vectors),
+                ]
+            )
+            self.used_bytes += partition.nbytes()
+            self._evict()
+
+    def remove(self, account_id: int, quote_id: str):
+        with self.lock:
+            self._changed(account_id)
+            self.oversized.discard(account_id)
+            partition = self.partitions.get(account_id)
+            if partition is not None:
+                self._remove_row(partition, quote_id)
+
+    def _remove_row(self, partition: Partition, quote_id: str):
+        if quote_id not in partition.ids:
+            return
+
+        ind = partition.ids.index(quote_id)
+        self.used_bytes -= partition.nbytes()
+        del partition.ids[ind]
+        del partition.payloads[ind]
+        kept_rows = partition.owners != ind
+        partition.vectors = partition.vectors[kept_rows]
+        partition.owners = partition.owners[kept_rows]
+        partition.owners[partition.owners > ind] -= 1
+        self.used_bytes += partition.nbytes()
+
+    def update_payload(self, account_id: int, quote_id: str, payload: dict):
+        with self.lock:
+            self._changed(account_id)
+            partition = self.partitions.get(account_id)
+            if partition is None or quote_id not in partition.ids:
+                return
+            partition.payloads[partition.ids.index(quote_id)].update(payload)
+
+    def clear(self):
+        with self.lock:
+            self.clears += 1
+            self.partitions.clear()
+            self.oversized.clear()
+            self.used_bytes = 0
+
+    def search(
+        self,
+        partition: Partition,
+        query_vector: np.ndarray,
+        limit: int,
+        exclude_text: str | None = None,
+    ) -> list[models.ScoredPoint]:
+        if len(partition.ids) == 0:
+            return []
+
+        # Max-sim: a quote scores as its best matching chunk
+        scores = np.full(len(partition.ids), -np.inf, dtype=np.float32)
+        np.maximum.at(
+            scores, partition.owners, partition.vectors @ normalize(query_vector)
+        )
+        if exclude_text is not None:
+            for ind, payload in enumerate(partition.payloads):
+                if payload["quote_text"] == exclude_text:
+                    scores[ind] = -np.inf
+
+        candidates = min(limit, len(scores))
+        best = np.argpartition(-scores, candidates - 1)[:candidates]
+        best = best[np.argsort(-scores[best])]
+        return [
+            models.ScoredPoint(
+                id=partition.ids[ind],
+                version=0,
+                score=float(scores[ind]),
+                payload=partition.payloads[ind],
+            )
+            for ind in best
+            if scores[ind] != -np.inf
+        ]
+
+    def _drop(self, account_id: int):
+        partition = self.partitions.pop(account_id, None)
+        if partition is not None:
+            self.used_bytes -= partition.nbytes()
+
+    def _evict(self):
+        while self.used_bytes > self.max_bytes and len(self.partitions) > 0:
+            _, partition = self.partitions.popitem(last=False)
+            self.used_bytes -= partition.nbytes()
@@ -1,42 +1,199 @@
+import asyncio
+import html
 import logging
 import os
 import random
+import time
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Callable
 
 from admin_handler import get_admin_handler
-from db_handler import DBHandler, Quote, QuoteWithId
-from telegram import ChatMember, Poll, Update
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes
+from db_handler import DBHandler, Quote, QuoteWithId, purge_filter
+from qdrant_guard import DBUnavailableError
+from telegram import ChatMember, Message, Poll, Update
+from telegram.constants import ChatType
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    ChatMemberHandler,
+    CommandHandler,
+    ContextTypes,
+    MessageHandler,
+    filters,
+)
 from utils import (
-    datetime_to_rfc3339,
+    datetime_to_epoch,
+    epoch_to_datetime,
     get_message_url,
-    rfc3339_to_datetime,
+    html_to_text,
+    render_entities,
     sanitize_markdown,
 )
+from write_queue import QuoteWriteQueue, WriteResult, WriteStatus
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DEBUG = os.environ.get("DEBUG", False)
+QDRANT_HOST = os.environ.get("QDRANT_HOST", "localhost")
+QDRANT_PORT = int(os.environ.get("QDRANT_PORT", 6333))
+QDRANT_GRPC_PORT = int(os.environ.get("QDRANT_GRPC_PORT", 6334))
+QDRANT_PREFER_GRPC = os.environ.get("QDRANT_PREFER_GRPC", "false").lower() == "true"
+# Memory for the in-process copy of small users' quotes, 0 disables it
+HOT_INDEX_MAX_MB = int(os.environ.get("HOT_INDEX_MAX_MB", 64))
+# Reduces the stored embeddings to this many dimensions, 0 keeps the full ones
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 0))
+# Quotes posted longer ago than this are deleted in the background, 0 keeps them forever
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 0))
+RETENTION_CHECK_INTERVAL_SECONDS = 24 * 60 * 60
+# Deletes all quotes of a group once the bot is removed from it
+PURGE_ON_LEAVE = os.environ.get("PURGE_ON_LEAVE", "false").lower() == "true"
+# How often Qdrant is checked while calls to it fail fast
+HEALTH_PROBE_INTERVAL_SECONDS = int(os.environ.get("HEALTH_PROBE_INTERVAL_SECONDS", 5))
+
+# Open /bulkquote sessions without a forward for this long are dropped. Their quotes are
+# still saved, only the summary is lost.
+BULK_SESSION_TIMEOUT_SECONDS = 10 * 60
+
+UNAVAILABLE_MESSAGE = (
+    "The quote database is unavailable right now, please try again later."
+)
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 
 db_handler: DBHandler | None
+write_queue: QuoteWriteQueue | None
+
+
+@dataclass(slots=True)
+class BulkSession:
+    last_forward: float = field(default_factory=time.monotonic)
+    # Pending results of the forwarded messages that are being saved
+    writes: list[asyncio.Future[WriteResult]] = field(default_factory=list)
+    # Hidden accounts, channels, bots and messages without text
+    unattributed: int = 0
+    # Forwards of the sender's own messages, nobody can quote themselves
+    own_messages: int = 0
+
+
+# Per (chat_id, user_id) with an open /bulkquote
+bulk_sessions: dict[tuple[int, int], BulkSession] = {}
+
+
+def drop_expired_bulk_sessions():
+    now = time.monotonic()
+    for key, session in list(bulk_sessions.items()):
+        if now - session.last_forward > BULK_SESSION_TIMEOUT_SECONDS:
+            del bulk_sessions[key]
+
+
+# Groups the bot was removed from whose purge failed, retried by the health probe
+pending_group_purges: set[int] = set()
+
+retention_task: asyncio.Task | None = None
+health_probe_task: asyncio.Task | None = None
+
+
+async def enforce_retention():
+    while True:
+        posted_before = int(datetime.now().timestamp()) - RETENTION_DAYS * 24 * 60 * 60
+        try:
+            result = await asyncio.to_thread(
+                db_handler.purge_quotes, purge_filter(posted_before=posted_before)
+            )
+            print(
+                f"Retention: removed {result.removed} quotes older than "
+                f"{RETENTION_DAYS} days in {result.seconds:.1f}s"
+            )
+        except Exception as e:
+            print(f"Retention: purge failed: {e}")
+        await asyncio.sleep(RETENTION_CHECK_INTERVAL_SECONDS)
+
+
+async def probe_health():
+    while True:
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL_SECONDS)
+        if not db_handler.is_available():
+            await asyncio.to_thread(db_handler.probe_health)
+        if db_handler.is_available():
+            for group_id in list(pending_group_purges):
+                await purge_group(group_id)
+
+
+async def purge_group(group_id: int):
+    try:
+        result = await asyncio.to_thread(
+            db_handler.purge_quotes, purge_filter(group_id=group_id)
+        )
+    except DBUnavailableError as e:
+        print(f"Purging {group_id} failed, retrying once Qdrant is available: {e}")
+        pending_group_purges.add(group_id)
+        return
+    except Exception as e:
+        # Runs from the health probe as well, which must keep going
+        print(f"Purging {group_id} failed: {e}")
+        pending_group_purges.discard(group_id)
+        return
+    pending_group_purges.discard(group_id)
+    print(
+        f"Removed from {group_id}: deleted {result.removed} quotes in {result.seconds:.1f}s"
+    )
 
 
 async def post_init(application: Application) -> None:
+    global retention_task, health_probe_task
+    write_queue.start()
+    health_probe_task = asyncio.create_task(probe_health())
+    if RETENTION_DAYS > 0:
+        retention_task = asyncio.create_task(enforce_retention())
     await application.bot.set_my_commands(
         [
             ("quote", "Quote stuff"),
+            ("bulkquote", "Quote all messages you forward until /bulkquote_done"),
+            ("bulkquote_done", "Save the forwarded messages"),
             ("unquote", "Unquote stuff"),
             ("embarrass", "Embarrass a user"),
             ("embarrass_semantic", "Embarrass a user semantically"),
             ("quotequiz", "Fun quiz"),
+            ("quotestats", "Who gets quoted the most"),
         ]
     )
 
 
+async def post_shutdown(application: Application) -> None:
+    if retention_task:
+        retention_task.cancel()
+    if health_probe_task:
+        health_probe_task.cancel()
+    await write_queue.stop()
+    if not db_handler.flush_payload_updates():
+        print(f"Dropping {len(db_handler.pending_payloads)} payload updates")
+    db_handler.stats.flush(force=True)
+    db_handler.centroids.flush(force=True)
+
+
+# Handlers don't check for Qdrant outages themselves, a failing call ends up here
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    if not isinstance(context.error, DBUnavailableError):
+        logging.getLogger(__name__).error(
+            "Exception while handling an update", exc_info=context.error
+        )
+        return
+
+    print(f"Qdrant unavailable: {context.error}")
+    if isinstance(update, Update) and update.effective_message:
+        await update.effective_message.reply_text(UNAVAILABLE_MESSAGE)
+
+
+def message_to_quote_text(message: Message) -> str | None:
+    if message.text and message.text != "":
+        return sanitize_markdown(message)
+    if message.caption and message.caption != "":
+        return sanitize_markdown(message, use_caption=True)
+    return None
+
+
 async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
     quote_message = update.message.reply_to_message
@@ -74,21 +231,7 @@ async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    quote_text: str | None
-
-    if quote_message.text and quote_message.text != "":
-        quote_text = sanitize_markdown(quote_message)
-    else:
-        if quote_message.caption and quote_message.caption != "":
-            quote_text = sanitize_markdown(quote_message, use_caption=True)
-        else:
-            context.bot.send_message(
-                chat_id=chat_id,
-                reply_to_message_id=command_message_id,
-                text="There should be something to quote in the message.",
-            )
-            return
-
+    quote_text = message_to_quote_text(quote_message)
     if not quote_text:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -97,8 +240,26 @@ async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    existing_quote = db_handler.find_quote(quote_poster_uid, quote_text)
-    if existing_quote is not None:
+    new_quote: Quote = Quote(
+        group_id=update.effective_chat.id,
+        message_id=quote_message.message_id,
+        quote_text=quote_text,
+        account_id=quote_poster_uid,
+        post_date=datetime_to_epoch(quote_message.date),
+        last_quoted=datetime_to_epoch(quote_message.date),
+    )
+    result = await write_queue.submit(new_quote)
+
+    if result.status == WriteStatus.FAILED:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=command_message_id,
+            text="Saving the quote failed, please try again later.",
+        )
+        return
+
+    if result.status == WriteStatus.DUPLICATE:
+        existing_quote = result.quote
         if existing_quote.message_id == quote_message.message_id:
             text = "This message is already in the database."
         else:
@@ -106,18 +267,105 @@ async def quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
         return
 
-    new_quote: Quote = Quote(
-        group_id=chat_id,
-        message_id=quote_message.message_id,
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id, text="Message saved."
+    )
+
+
+async def bulkquote(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    command_message_id = update.message.message_id
+
+    if not db_handler:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=command_message_id,
+            text="Database is not connected.",
+        )
+        return
+
+    # Quotes link back to the original chat, which only works for groups
+    if update.effective_chat.type == ChatType.PRIVATE:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=command_message_id,
+            text="Bulk quoting only works in groups.",
+        )
+        return
+
+    drop_expired_bulk_sessions()
+    bulk_sessions.setdefault((chat_id, update.message.from_user.id), BulkSession())
+    await context.bot.send_message(
+        chat_id=chat_id,
+        reply_to_message_id=command_message_id,
+        text="Alright, forward me the messages to quote and send /bulkquote_done when you are finished.",
+    )
+
+
+async def bulkquote_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    forwarded_message = update.message
+    drop_expired_bulk_sessions()
+    session = bulk_sessions.get(
+        (update.effective_chat.id, forwarded_message.from_user.id)
+    )
+    if session is None:
+        return
+    session.last_forward = time.monotonic()
+
+    # Hidden accounts, channels and bots can't be attributed to a user
+    original_author = forwarded_message.forward_from
+    if original_author is None or original_author.is_bot:
+        session.unattributed += 1
+        return
+    if not DEBUG and original_author.id == forwarded_message.from_user.id:
+        session.own_messages += 1
+        return
+
+    quote_text = message_to_quote_text(forwarded_message)
+    if not quote_text:
+        session.unattributed += 1
+        return
+
+    new_quote = Quote(
+        group_id=update.effective_chat.id,
+        message_id=forwarded_message.message_id,
         quote_text=quote_text,
-        account_id=quote_poster_uid,
-        post_date=datetime_to_rfc3339(quote_message.date),
-        last_quoted=datetime_to_rfc3339(quote_message.date),
+        account_id=original_author.id,
+        post_date=datetime_to_epoch(forwarded_message.forward_date),
+        last_quoted=datetime_to_epoch(forwarded_message.forward_date),
     )
-    db_handler.save_quotes([new_quote])
+    # Don't wait for the write here, so consecutive forwards end up in one batch
+    session.writes.append(await write_queue.enqueue(new_quote))
+
+
+async def bulkquote_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    command_message_id = update.message.message_id
+
+    drop_expired_bulk_sessions()
+    session = bulk_sessions.pop((chat_id, update.message.from_user.id), None)
+    if session is None:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=command_message_id,
+            text="Start with /bulkquote first. Bulk quoting stops "
+            f"{BULK_SESSION_TIMEOUT_SECONDS // 60} minutes after the last forward.",
+        )
+        return
+
+    results = await asyncio.gather(*session.writes)
+    counts = {status: 0 for status in WriteStatus}
+    for result in results:
+        counts[result.status] += 1
 
     await context.bot.send_message(
-        chat_id=update.effective_chat.id, text="Message saved."
+        chat_id=chat_id,
+        reply_to_message_id=command_message_id,
+        text=f"Saved {counts[WriteStatus.SAVED]} quotes.\n"
+        f"{counts[WriteStatus.DUPLICATE]} were already quoted, "
+        f"{session.unattributed} could not be attributed or were empty, "
+        f"{session.own_messages} were your own messages, "
+        f"{counts[WriteStatus.FAILED]} failed.",
     )
 
 
@@ -136,7 +384,7 @@ async def post_quote(
         pass
 
     message_url = get_message_url(quote.group_id, quote.message_id)
-    parsed_post_date = rfc3339_to_datetime(quote.post_date)
+    parsed_post_date = epoch_to_datetime(quote.post_date)
 
     await context.bot.send_message(
         chat_id=chat_id,
@@ -155,7 +403,11 @@ async def embarrass_pseudo_random(update: Update, context: ContextTypes.DEFAULT_
 
 async def embarrass_semantic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     def quote_picker(account_id: int, response_to_text: str):
-        query = " ".join(context.args) if len(context.args) > 0 else response_to_text
+        # Queries are handled like stored quotes, so typed text is escaped the same way
+        if len(context.args) > 0:
+            query = render_entities(" ".join(context.args), [])
+        else:
+            query = response_to_text
         return db_handler.quote_for_user_by_query(account_id, query)
 
     await base_embarrass(update, context, quote_picker)
@@ -203,8 +455,10 @@ async def base_embarrass(
         )
         return
 
-    quote_text = response_to_message.text or response_to_message.caption
-    embarrass_quote = quote_picker(embarrass_uid, quote_text)
+    # Rendered like stored quotes, so the message itself can be excluded from the results
+    quote_text = message_to_quote_text(response_to_message)
+    # Qdrant calls block until their deadline, so they run off the event loop
+    embarrass_quote = await asyncio.to_thread(quote_picker, embarrass_uid, quote_text)
     if not embarrass_quote:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -237,7 +491,9 @@ async def unquote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    found_quote = db_handler.find_quote_by_message_id(quote_message.message_id)
+    found_quote = await asyncio.to_thread(
+        db_handler.find_quote_by_message_id, quote_message.message_id
+    )
     if found_quote is None:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -255,12 +511,86 @@ async def unquote(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    db_handler.delete_quote_by_id(found_quote.id)
+    await asyncio.to_thread(db_handler.delete_quote_by_id, found_quote.id)
     await context.bot.send_message(
         chat_id=chat_id, reply_to_message_id=command_message_id, text="Message deleted."
     )
 
 
+async def bot_membership_changed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    new_status = update.my_chat_member.new_chat_member.status
+    group_id = update.my_chat_member.chat.id
+    if new_status not in (ChatMember.LEFT, ChatMember.BANNED):
+        # Added back before a failed purge was retried, its quotes are wanted again
+        pending_group_purges.discard(group_id)
+        return
+
+    await purge_group(group_id)
+
+
+STATS_TOP_COUNT = 5
+STATS_MONTH_COUNT = 12
+
+
+async def quotestats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    command_message_id = update.message.message_id
+
+    if not db_handler:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=command_message_id,
+            text="Database is not connected.",
+        )
+        return
+
+    stats = db_handler.stats.snapshot(chat_id)
+    if not stats or len(stats.quotes_per_user) == 0:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            reply_to_message_id=command_message_id,
+            text="Nobody has been quoted here yet.",
+        )
+        return
+
+    lines = ["<b>Most quoted</b>"]
+    for account_id, count in stats.quotes_per_user.most_common(STATS_TOP_COUNT):
+        name = "Unknown"
+        try:
+            member = await context.bot.get_chat_member(chat_id, account_id)
+            name = html.escape(member.user.first_name)
+        except:
+            pass
+        lines.append(f'<a href="tg://user?id={account_id}">{name}</a>: {count}')
+
+    lines += ["", "<b>Quotes per month</b>"]
+    months = sorted(stats.quotes_per_month.items())[-STATS_MONTH_COUNT:]
+    lines += [f"{month}: {count}" for month, count in months]
+
+    top_resurfaced = stats.times_quoted.most_common(STATS_TOP_COUNT)
+    if len(top_resurfaced) > 0:
+        lines += ["", "<b>Brought up the most</b>"]
+        found_quotes = await asyncio.to_thread(
+            db_handler.get_quotes_by_ids, [x[0] for x in top_resurfaced]
+        )
+        found_quotes = {str(x.id): x for x in found_quotes}
+        for quote_id, count in top_resurfaced:
+            found_quote = found_quotes.get(quote_id)
+            if not found_quote:
+                continue
+            message_url = get_message_url(found_quote.group_id, found_quote.message_id)
+            lines.append(
+                f'<a href="{message_url}">{count}x</a>: "{found_quote.quote_text}"'
+            )
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        reply_to_message_id=command_message_id,
+        text="\n".join(lines),
+        parse_mode="HTML",
+    )
+
+
 antispam_quotequiz: dict[str, datetime] = {}
 
 
@@ -305,7 +635,9 @@ async def quotequiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     selected_member = random.choice(members_in_chat)
-    selected_quote = db_handler.pseudo_random_quote_for_user(selected_member.user.id)
+    selected_quote = await asyncio.to_thread(
+        db_handler.pseudo_random_quote_for_user, selected_member.user.id
+    )
     if not selected_quote:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -318,8 +650,17 @@ async def quotequiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     poster_link = f'<a href="tg://user?id={selected_member.user.id}">{selected_member.user.first_name}</a>'
     message_url = get_message_url(selected_quote.group_id, selected_quote.message_id)
 
-    other_members = [x for x in members_in_chat if x.user.id != selected_member.user.id]
-    other_options = random.sample(other_members, min(9, len(other_members)))
+    # The hardest distractors are the people who sound the most alike
+    other_members = {
+        x.user.id: x for x in members_in_chat if x.user.id != selected_member.user.id
+    }
+    similar_ids = await asyncio.to_thread(
+        db_handler.similar_users,
+        selected_quote.quote_text,
+        list(other_members.keys()),
+        k=min(9, len(other_members)),
+    )
+    other_options = [other_members[x] for x in similar_ids]
 
     all_options = [selected_member] + other_options
     random.shuffle(all_options)
@@ -330,7 +671,8 @@ async def quotequiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [
             "Who would say this?",
             "",
-            *('"' + selected_quote.quote_text + '"').split("\n"),
+            # Poll questions are plain text
+            *('"' + html_to_text(selected_quote.quote_text) + '"').split("\n"),
         ]
     )
     await context.bot.send_poll(
@@ -348,12 +690,33 @@ async def quotequiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 if __name__ == "__main__":
-    db_handler = DBHandler()
-    application = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+    db_handler = DBHandler(
+        host=QDRANT_HOST,
+        port=QDRANT_PORT,
+        grpc_port=QDRANT_GRPC_PORT,
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        hot_index_max_bytes=HOT_INDEX_MAX_MB * 1024 * 1024,
+        embedding_dimensions=EMBEDDING_DIMENSIONS or None,
+    )
+    write_queue = QuoteWriteQueue(db_handler)
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    quote_handler = CommandHandler("quote", quote)
+    # Non blocking, so quotes from different chats can share a write batch
+    quote_handler = CommandHandler("quote", quote, block=False)
     application.add_handler(quote_handler)
 
+    bulkquote_handler = CommandHandler("bulkquote", bulkquote)
+    application.add_handler(bulkquote_handler)
+
+    bulkquote_done_handler = CommandHandler("bulkquote_done", bulkquote_done)
+    application.add_handler(bulkquote_done_handler)
+
     unquote_handler = CommandHandler("unquote", unquote)
     application.add_handler(unquote_handler)
 
@@ -368,6 +731,23 @@ if __name__ == "__main__":
     quotequiz_handler = CommandHandler("quotequiz", quotequiz)
     application.add_handler(quotequiz_handler)
 
+    quotestats_handler = CommandHandler("quotestats", quotestats)
+    application.add_handler(quotestats_handler)
+
     application.add_handler(get_admin_handler(db_handler=db_handler))
 
+    if PURGE_ON_LEAVE:
+        membership_handler = ChatMemberHandler(
+            bot_membership_changed, ChatMemberHandler.MY_CHAT_MEMBER
+        )
+        application.add_handler(membership_handler)
+
+    bulkquote_collect_handler = MessageHandler(
+        filters.UpdateType.MESSAGE & filters.FORWARDED & ~filters.COMMAND,
+        bulkquote_collect,
+    )
+    application.add_handler(bulkquote_collect_handler)
+
+    application.add_error_handler(handle_error)
+
     application.run_polling()
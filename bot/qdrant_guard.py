@@ -0,0 +1,165 @@
+import random
+import threading
+import time
+from typing import Any, Callable, TypeVar
+
+import grpc
+import httpx
+from qdrant_client import QdrantClient
+from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+
+T = TypeVar("T")
+
+# Seconds an operation may take before it counts as failed
+DEFAULT_DEADLINE = 10
+OPERATION_DEADLINES = {
+    "search": 3,
+    "search_batch": 3,
+    "retrieve": 3,
+    "count": 5,
+    "scroll": 10,
+    "get_collections": 3,
+    "get_collection": 3,
+    "upsert": 15,
+    "delete": 15,
+    "batch_update_points": 15,
+    # Collection management only happens at startup or from the admin panel
+    "create_collection": 120,
+    "recreate_collection": 120,
+    "delete_collection": 120,
+    "update_collection": 120,
+    "create_payload_index": 120,
+    "create_snapshot": 600,
+    "delete_snapshot": 120,
+    # Snapshot transfers go through the REST API directly, see GuardedClient.run
+    "download_snapshot": 600,
+    "upload_snapshot": 600,
+}
+
+# Reads can be repeated safely, writes are not retried to avoid applying them twice
+IDEMPOTENT_OPERATIONS = {
+    "search",
+    "search_batch",
+    "retrieve",
+    "count",
+    "scroll",
+    "get_collections",
+    "get_collection",
+}
+MAX_RETRIES = 2
+RETRY_BASE_DELAY_SECONDS = 0.2
+
+# Consecutive failures after which calls fail fast until the health probe succeeds
+FAILURE_THRESHOLD = 3
+
+
+class DBUnavailableError(Exception):
+    pass
+
+
+# Only errors that say something about the health of Qdrant, not about the request
+def is_unavailable(error: Exception) -> bool:
+    # Also wraps responses that didn't validate, only transport failures count
+    if isinstance(error, ResponseHandlingException):
+        return is_unavailable(error.source)
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code is not None and error.status_code >= 500
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    if isinstance(error, grpc.RpcError):
+        return error.code() in (
+            grpc.StatusCode.UNAVAILABLE,
+            grpc.StatusCode.DEADLINE_EXCEEDED,
+        )
+    return isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD):
+        self.failure_threshold = failure_threshold
+        self.consecutive_failures = 0
+        self.is_open = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        if self.is_open:
+            raise DBUnavailableError("Qdrant is unavailable")
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if not self.is_open and self.consecutive_failures >= self.failure_threshold:
+                print("Qdrant keeps failing, failing fast until it is healthy again")
+                self.is_open = True
+
+    def close(self):
+        with self.lock:
+            if self.is_open:
+                print("Qdrant is healthy again")
+            self.is_open = False
+            self.consecutive_failures = 0
+
+
+# Stands in for a QdrantClient. Every call gets the deadline of its operation, reads
+# are retried with jittered backoff and failures feed the circuit breaker.
+class GuardedClient:
+    def __init__(self, create_client: Callable[[int], QdrantClient]):
+        self.create_client = create_client
+        # Timeouts are fixed per client, so there is one client per deadline
+        self.clients: dict[int, QdrantClient] = {}
+        self.clients_lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+
+    # Calls come from the event loop's worker threads, so creating clients is locked
+    def _client(self, deadline: int) -> QdrantClient:
+        with self.clients_lock:
+            if deadline not in self.clients:
+                self.clients[deadline] = self.create_client(deadline)
+            return self.clients[deadline]
+
+    def __getattr__(self, operation: str) -> Callable[..., Any]:
+        def guarded_call(*args, **kwargs):
+            return self.run(
+                operation,
+                lambda deadline: getattr(self._client(deadline), operation)(
+                    *args, **kwargs
+                ),
+            )
+
+        return guarded_call
+
+    # Runs request with the deadline of operation, for requests the client doesn't
+    # cover. Gets the same retries and breaker accounting as client calls.
+    def run(self, operation: str, request: Callable[[int], T]) -> T:
+        deadline = OPERATION_DEADLINES.get(operation, DEFAULT_DEADLINE)
+        retries = MAX_RETRIES if operation in IDEMPOTENT_OPERATIONS else 0
+
+        self.breaker.check()
+        for attempt in range(retries + 1):
+            try:
+                result = request(deadline)
+            except Exception as e:
+                if not is_unavailable(e):
+                    raise
+                if attempt == retries or self.breaker.is_open:
+                    # Once per call, retries don't make a single slow call count more
+                    self.breaker.record_failure()
+                    raise DBUnavailableError(f"Qdrant {operation} failed: {e}") from e
+                time.sleep(random.uniform(0, RETRY_BASE_DELAY_SECONDS * 2**attempt))
+            else:
+                self.breaker.record_success()
+                return result
+        raise AssertionError("unreachable")
+
+    # Bypasses the breaker, used by the health probe to find out when to close it
+    def probe(self) -> bool:
+        try:
+            self._client(OPERATION_DEADLINES["get_collections"]).get_collections()
+        except Exception:
+            return False
+        self.breaker.close()
+        return True
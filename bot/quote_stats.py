@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from utils import epoch_to_datetime
+
+STATS_PATH = "./quote_stats.json"
+
+# Writes to disk are batched, the stats can always be rebuilt from the database
+FLUSH_INTERVAL_SECONDS = 60
+
+
+def to_month(post_date: int) -> str:
+    return epoch_to_datetime(post_date).strftime("%Y-%m")
+
+
+# Keeps counters free of empty entries
+def decrement(counter: Counter, key):
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+@dataclass(slots=True)
+class GroupStats:
+    quotes_per_user: Counter[int] = field(default_factory=Counter)
+    quotes_per_month: Counter[str] = field(default_factory=Counter)
+    times_quoted: Counter[str] = field(default_factory=Counter)
+
+    def to_dict(self) -> dict:
+        return {
+            "quotes_per_user": self.quotes_per_user,
+            "quotes_per_month": self.quotes_per_month,
+            "times_quoted": self.times_quoted,
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "GroupStats":
+        return GroupStats(
+            # JSON object keys are always strings
+            quotes_per_user=Counter(
+                {int(k): v for k, v in data["quotes_per_user"].items()}
+            ),
+            quotes_per_month=Counter(data["quotes_per_month"]),
+            times_quoted=Counter(data["times_quoted"]),
+        )
+
+
+# Per group aggregates that are updated on every write, so stats never need a scan.
+# Writes arrive from the write queue thread as well, hence the lock.
+class QuoteStats:
+    def __init__(self, path: str = STATS_PATH):
+        self.lock = threading.RLock()
+        self.path = path
+        self.groups: dict[int, GroupStats] = {}
+        self.dirty = False
+        self.last_flush = 0.0
+
+    # Fails if there is nothing readable stored or it doesn't cover quote_count quotes.
+    # The file is only written once in a while, so it misses the last changes after a
+    # crash.
+    def load(self, quote_count: int) -> bool:
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path) as stats_file:
+                data = json.load(stats_file)
+            groups = {int(k): GroupStats.from_dict(v) for k, v in data.items()}
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            print(f"Ignoring unreadable {self.path}: {e}")
+            return False
+        if sum(x.quotes_per_user.total() for x in groups.values()) != quote_count:
+            return False
+        self.groups = groups
+        return True
+
+    def flush(self, force: bool = False):
+        with self.lock:
+            if not self.dirty:
+                return
+            if not force and time.time() - self.last_flush < FLUSH_INTERVAL_SECONDS:
+                return
+            # Written next to the old file and swapped in, so a crash can't truncate it
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as stats_file:
+                json.dump({k: v.to_dict() for k, v in self.groups.items()}, stats_file)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+            self.last_flush = time.time()
+
+    # Copies, the write queue thread keeps changing the counters while handlers read them
+    def snapshot(self, group_id: int) -> GroupStats | None:
+        with self.lock:
+            stats = self.groups.get(group_id)
+            if stats is None:
+                return None
+            return GroupStats(
+                quotes_per_user=stats.quotes_per_user.copy(),
+                quotes_per_month=stats.quotes_per_month.copy(),
+                times_quoted=stats.times_quoted.copy(),
+            )
+
+    def quoted_user_ids(self) -> set[int]:
+        with self.lock:
+            return {
+                account_id
+                for stats in self.groups.values()
+                for account_id in stats.quotes_per_user
+            }
+
+    def group(self, group_id: int) -> GroupStats:
+        return self.groups.setdefault(group_id, GroupStats())
+
+    def _changed(self):
+        self.dirty = True
+        self.flush()
+
+    def add_quote(
+        self,
+        group_id: int,
+        quote_id: str,
+        account_id: int,
+        post_date: int,
+        times_quoted: int = 0,
+    ):
+        with self.lock:
+            stats = self.group(group_id)
+            stats.quotes_per_user[account_id] += 1
+            stats.quotes_per_month[to_month(post_date)] += 1
+            if times_quoted > 0:
+                stats.times_quoted[quote_id] = times_quoted
+            self._changed()
+
+    def remove_quote(
+        self, group_id: int, quote_id: str, account_id: int, post_date: int
+    ):
+        with self.lock:
+            stats = self.group(group_id)
+            decrement(stats.quotes_per_user, account_id)
+            decrement(stats.quotes_per_month, to_month(post_date))
+            del stats.times_quoted[quote_id]
+            self._changed()
+
+    def quote_resurfaced(self, group_id: int, quote_id: str):
+        with self.lock:
+            self.group(group_id).times_quoted[quote_id] += 1
+            self._changed()
+
+    def clear(self):
+        with self.lock:
+            self.groups = {}
+            self.dirty = True
+            self.flush(force=True)
+
+    # Rebuilds everything from (group_id, quote_id, account_id, post_date, times_quoted) rows
+    def rebuild(self, entries: Iterable[tuple[int, str, int, int, int]]):
+        groups: dict[int, GroupStats] = {}
+        for group_id, quote_id, account_id, post_date, times_quoted in entries:
+            stats = groups.setdefault(group_id, GroupStats())
+            stats.quotes_per_user[account_id] += 1
+            stats.quotes_per_month[to_month(post_date)] += 1
+            if times_quoted > 0:
+                stats.times_quoted[quote_id] = times_quoted
+
+        with self.lock:
+            self.groups = groups
+            self.dirty = True
+            self.flush(force=True)
@@ -1,11 +1,29 @@
+import html
 import os
-from typing import Union
+import random
+import re
 
+import numpy as np
 from sentence_transformers import SentenceTransformer
-from torch import Tensor
 
 default_model = "paraphrase-multilingual-MiniLM-L12-v2"
 
+# Long quotes are split into at most this many chunks, the rest is dropped
+MAX_CHUNKS = 4
+
+# Tokens shared by consecutive chunks, so sentences on a boundary aren't lost
+CHUNK_OVERLAP = 16
+
+# Upper bound for the quotes used to fit or evaluate a projection
+MAX_PROJECTION_SAMPLES = 5000
+MAX_EVALUATION_SAMPLES = 2000
+
+RECALL_K = 5
+
+# Share of the evaluation samples the projection is fitted on, recall is measured on
+# the rest
+EVALUATION_FIT_SHARE = 0.5
+
 
 def to_model_path(model_name: str) -> str:
     return "./models/" + model_name
@@ -23,13 +41,161 @@ def load_model(model_name: str) -> SentenceTransformer:
     return loaded_model
 
 
+# Quotes are stored as Telegram HTML, the tags are only noise for the model
+def strip_markup(text: str) -> str:
+    text = re.sub(r"<[^>]+>", " ", text)
+    return re.sub(r"\s+", " ", html.unescape(text)).strip()
+
+
+def to_projection_path(model_name: str, dimensions: int) -> str:
+    return to_model_path(model_name) + f"/pca_{dimensions}.npy"
+
+
+# Returns the principal axes (dimensions, features) of the rows of data.
+# Embeddings are projected onto them without centering, so at full rank the
+# projection is a rotation and cosine similarities stay the same.
+def fit_pca(data: np.ndarray, dimensions: int) -> np.ndarray:
+    _, _, components = np.linalg.svd(data - data.mean(axis=0), full_matrices=False)
+    return components[:dimensions]
+
+
+# Indices of the k most cosine similar rows for every row, excluding the row itself
+def nearest_neighbours(data: np.ndarray, k: int) -> np.ndarray:
+    data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+    similarities = data @ data.T
+    np.fill_diagonal(similarities, -np.inf)
+    return np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+
+
+def sample(data: list[str], max_size: int) -> list[str]:
+    if len(data) <= max_size:
+        return data
+    return random.sample(data, max_size)
+
+
 class TextEmbedder:
     model: SentenceTransformer
     model_name: str
+    # Number of dimensions to reduce embeddings to, None keeps the model's output
+    reduced_dimensions: int | None
+    projection: np.ndarray | None
 
-    def __init__(self, model_name: str = default_model):
+    def __init__(
+        self, model_name: str = default_model, reduced_dimensions: int | None = None
+    ):
         self.model_name = model_name
         self.model = load_model(model_name)
+        self.reduced_dimensions = reduced_dimensions
+        self.projection = None
+        self.load_projection()
+
+    def full_dimensions(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def dimensions(self) -> int:
+        if self.projection is None:
+            return self.full_dimensions()
+        return self.projection.shape[0]
+
+    def load_projection(self):
+        if not self.reduced_dimensions:
+            return
+        projection_path = to_projection_path(self.model_name, self.reduced_dimensions)
+        if os.path.isfile(projection_path):
+            self.projection = np.load(projection_path)
+
+    def needs_projection(self) -> bool:
+        return bool(self.reduced_dimensions) and self.projection is None
+
+    # Fits the projection on our own quotes and stores it next to the model.
+    # With fewer quotes than dimensions the full embeddings are kept for now.
+    def fit_projection(self, data: list[str]):
+        data = sample(data, MAX_PROJECTION_SAMPLES)
+        if len(data) < self.reduced_dimensions:
+            print(
+                f"Only {len(data)} quotes, need {self.reduced_dimensions} to reduce "
+                "dimensions, keeping full embeddings"
+            )
+            return
+
+        print(f"Fitting {self.reduced_dimensions} dimensional projection")
+        projection = fit_pca(self._encode(data), self.reduced_dimensions)
+        np.save(
+            to_projection_path(self.model_name, self.reduced_dimensions), projection
+        )
+        self.projection = projection
+
+    # Recall@5 of nearest neighbour search among our quotes for every dimension count,
+    # compared to the full embeddings. The projection is fitted on other quotes than the
+    # ones it is evaluated on, like it is applied to new quotes later.
+    def evaluate_reduction(
+        self, data: list[str], dimension_counts: list[int]
+    ) -> dict[int, float]:
+        data = random.sample(data, min(len(data), MAX_EVALUATION_SAMPLES))
+        fit_count = int(len(data) * EVALUATION_FIT_SHARE)
+        if len(data) - fit_count <= RECALL_K:
+            return {}
+
+        full = self._encode(data)
+        fit_data, evaluation_data = full[:fit_count], full[fit_count:]
+        expected = nearest_neighbours(evaluation_data, RECALL_K)
+        recalls = {}
+        for dimensions in dimension_counts:
+            if dimensions > min(fit_count, self.full_dimensions()):
+                continue
+            projection = fit_pca(fit_data, dimensions)
+            found = nearest_neighbours(evaluation_data @ projection.T, RECALL_K)
+            hits = sum(
+                len(set(x) & set(y)) for x, y in zip(expected.tolist(), found.tolist())
+            )
+            recalls[dimensions] = hits / (len(evaluation_data) * RECALL_K)
+        return recalls
+
+    def _encode(self, data: list[str]) -> np.ndarray:
+        return self.model.encode([strip_markup(x) for x in data])
+
+    def _project(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.projection is None:
+            return embeddings
+        return embeddings @ self.projection.T
+
+    # Leaves room for the special tokens the model adds to every sequence
+    def max_chunk_tokens(self) -> int:
+        return self.model.max_seq_length - 2
+
+    def chunk(self, text: str) -> list[str]:
+        text = strip_markup(text)
+        offsets = self.model.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        max_tokens = self.max_chunk_tokens()
+        if len(offsets) <= max_tokens:
+            return [text]
+
+        chunks = []
+        stride = max_tokens - CHUNK_OVERLAP
+        for start in range(0, len(offsets), stride):
+            end = min(start + max_tokens, len(offsets))
+            chunks.append(text[offsets[start][0] : offsets[end - 1][1]])
+            if end == len(offsets) or len(chunks) == MAX_CHUNKS:
+                break
+        return chunks
+
+    # One vector per text, longer texts are truncated by the model. Texts are expected
+    # in the escaped HTML quotes are stored in, plain text has to be escaped first.
+    def embed(self, data: list[str]) -> np.ndarray:
+        return self._project(self._encode(data))
+
+    # One (chunks, dimension) matrix per text, all chunks are encoded in one call
+    def embed_chunked(self, data: list[str]) -> list[np.ndarray]:
+        chunked = [self.chunk(x) for x in data]
+        embeddings = self._project(
+            self.model.encode([x for chunks in chunked for x in chunks])
+        )
 
-    def embed(self, data: list[str]) -> list[Tensor]:
-        return self.model.encode(data)
+        out = []
+        start = 0
+        for chunks in chunked:
+            out.append(embeddings[start : start + len(chunks)])
+            start += len(chunks)
+        return out
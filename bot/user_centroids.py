@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+import zipfile
+from typing import Iterable
+
+import numpy as np
+from hot_index import normalize
+
+CENTROIDS_PATH = "./user_centroids.npz"
+
+# Writes to disk are batched, the centroids can always be rebuilt from the database
+FLUSH_INTERVAL_SECONDS = 60
+
+
+# A quote is represented by the mean direction of its chunks
+def quote_vector(chunks: np.ndarray) -> np.ndarray:
+    return normalize(normalize(chunks).reshape(-1, chunks.shape[-1]).mean(axis=0))
+
+
+# Running sum and count of the quote vectors of every user, so a user's style can be
+# compared to a text without looking at their quotes
+class UserCentroids:
+    def __init__(self, path: str = CENTROIDS_PATH):
+        self.lock = threading.RLock()
+        self.path = path
+        self.sums: dict[int, np.ndarray] = {}
+        self.counts: dict[int, int] = {}
+        self.dirty = False
+        self.last_flush = 0.0
+
+    # Fails if there is nothing readable stored, it was built for another vector size or it
+    # doesn't cover quote_count quotes, e.g. because changes were lost in a crash
+    def load(self, dimensions: int, quote_count: int) -> bool:
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                sums = data["sums"]
+                counts = data["counts"].tolist()
+                account_ids = data["account_ids"].tolist()
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            print(f"Ignoring unreadable {self.path}: {e}")
+            return False
+        if sums.shape[1:] != (dimensions,) or sum(counts) != quote_count:
+            return False
+        self.sums = dict(zip(account_ids, sums))
+        self.counts = dict(zip(account_ids, counts))
+        return True
+
+    def flush(self, force: bool = False):
+        with self.lock:
+            if not self.dirty:
+                return
+            if not force and time.time() - self.last_flush < FLUSH_INTERVAL_SECONDS:
+                return
+            account_ids = list(self.sums.keys())
+            # Written next to the old file and swapped in, so a crash can't truncate it
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "wb") as centroids_file:
+                np.savez(
+                    centroids_file,
+                    account_ids=np.array(account_ids, dtype=np.int64),
+                    sums=np.array(
+                        [self.sums[x] for x in account_ids], dtype=np.float32
+                    ),
+                    counts=np.array([self.counts[x] for x in account_ids]),
+                )
+            os.replace(temp_path, self.path)
+            self.dirty = False
+            self.last_flush = time.time()
+
+    def _changed(self):
+        self.dirty = True
+        self.flush()
+
+    def add(self, account_id: int, chunks: np.ndarray):
+        vector = quote_vector(chunks)
+        with self.lock:
+            self.sums[account_id] = self.sums.get(account_id, 0) + vector
+            self.counts[account_id] = self.counts.get(account_id, 0) + 1
+            self._changed()
+
+    def remove(self, account_id: int, chunks: np.ndarray):
+        vector = quote_vector(chunks)
+        with self.lock:
+            if account_id not in self.sums:
+                return
+            self.counts[account_id] -= 1
+            if self.counts[account_id] <= 0:
+                del self.sums[account_id]
+                del self.counts[account_id]
+            else:
+                self.sums[account_id] = self.sums[account_id] - vector
+            self._changed()
+
+    # Drops everything including the file, e.g. after the vectors were recomputed
+    def discard(self):
+        with self.lock:
+            self.sums = {}
+            self.counts = {}
+            self.dirty = False
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    # Rebuilds everything from (account_id, chunk vectors) rows
+    def rebuild(self, entries: Iterable[tuple[int, np.ndarray]]):
+        sums: dict[int, np.ndarray] = {}
+        counts: dict[int, int] = {}
+        for account_id, chunks in entries:
+            sums[account_id] = sums.get(account_id, 0) + quote_vector(chunks)
+            counts[account_id] = counts.get(account_id, 0) + 1
+
+        with self.lock:
+            self.sums = sums
+            self.counts = counts
+            self.dirty = True
+            self.flush(force=True)
+
+    # Orders the candidates by how close their centroid is to vector, closest first.
+    # Candidates without any quotes come last.
+    def nearest(self, vector: np.ndarray, candidates: list[int], k: int) -> list[int]:
+        with self.lock:
+            known = [x for x in candidates if x in self.sums]
+            centroids = np.array([self.sums[x] for x in known], dtype=np.float32)
+        unknown = [x for x in candidates if x not in self.sums]
+        if len(known) == 0:
+            return unknown[:k]
+
+        scores = normalize(centroids) @ normalize(vector)
+        ranked = [known[ind] for ind in np.argsort(-scores)]
+        return (ranked + unknown)[:k]
@@ -1,59 +1,202 @@
+import html
 import re
 from datetime import datetime
+from typing import Callable, Sequence
 
-from telegram import Message
+from telegram import Message, MessageEntity
+
+ENTITY_TAGS = {
+    "bold": "b",
+    "italic": "i",
+    "strikethrough": "s",
+    "underline": "u",
+    "code": "code",
+    "pre": "pre",
+    "spoiler": "tg-spoiler",
+    "text_link": "a",
+}
+
+ENTITY_CLOSE, ENTITY_OPEN = range(2)
+
+# Tags render_entities produces, links capture their URL
+RENDERED_TAG_PATTERN = re.compile(
+    "|".join(
+        [f"</?{x}>" for x in ENTITY_TAGS.values() if x != "a"]
+        + ['<a href="([^"]*)">', "</a>"]
+    )
+)
 
 
 def sanitize_markdown(message: Message, use_caption: bool = False) -> str | None:
     if use_caption:
-        if len(message.caption_entities) == 0:
-            return message.caption
         message_text = message.caption
         entities = message.caption_entities
     else:
-        if len(message.entities) == 0:
-            return message.text
         message_text = message.text
         entities = message.entities
 
-    # Replaces @ at the beginning of a word with ＠
-    message_text: str = re.sub(r"(\s)@", r"\1＠", message_text)
+    if message_text is None:
+        return None
 
-    # Guarantee that they are in the correct order
-    entities = sorted(entities, key=lambda x: x.offset)
-    quote = message_text[: entities[0].offset]
-    for i in range(len(entities)):
-        entity = entities[i]
-        start = entity.offset
-        end = entity.offset + entity.length
-        if i + 1 < len(entities):
-            start_next_entity = entities[i + 1].offset
-        else:
-            start_next_entity = None
+    # Replaces @ at the beginning of a word with ＠ (same UTF-16 length, so offsets stay valid)
+    message_text = re.sub(r"(\s)@", r"\1＠", message_text)
+    return render_entities(message_text, entities)
+
+
+OPEN_TAGS = {x: f"<{tag}>" for x, tag in ENTITY_TAGS.items()}
+CLOSE_TAGS = {x: f"</{tag}>" for x, tag in ENTITY_TAGS.items()}
+
+
+def _open_tag(entity: MessageEntity) -> str:
+    if entity.type == "text_link":
+        return f'<a href="{html.escape(entity.url)}">'
+    return OPEN_TAGS[entity.type]
+
+
+# Index into text for every UTF-16 offset. Characters outside the BMP take two code
+# units, an offset between those points to the next character.
+def _utf16_indices(text: str) -> list[int]:
+    indices = []
+    for ind, char in enumerate(text):
+        indices.append(ind)
+        if ord(char) > 0xFFFF:
+            indices.append(ind + 1)
+    indices.append(len(text))
+    return indices
+
+
+def _escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+# Renders text with Telegram entities as HTML in a single pass.
+# Entity offsets count UTF-16 code units, so they are mapped to indices into text first.
+# Overlapping entities are closed and reopened, so the result is always well nested.
+def render_entities(text: str, entities: Sequence[MessageEntity]) -> str:
+    # Most messages contain nothing to escape, slicing is enough for those
+    escape = _escape if "&" in text or "<" in text or ">" in text else str
+    if len(entities) == 0:
+        return escape(text)
 
-        if entity.type == "text_link":
-            quote += f'<a href="{entity.url}">{message_text[start:end]}</a>{message_text[end:start_next_entity]}'
+    # Plain BMP text needs no mapping, which is by far the most common case
+    if text.isascii() or max(text) <= "\uffff":
+        indices = None
+        text_length = len(text)
+    else:
+        indices = _utf16_indices(text)
+        text_length = len(indices) - 1
+
+    # Entities usually come sorted and neither nest nor overlap, then text and tags
+    # just alternate. The first entity starting before the previous one ended hands
+    # over to the sweep, which handles everything else.
+    parts: list[str] = []
+    cursor = 0
+    for entity in entities:
+        close_tag = CLOSE_TAGS.get(entity.type)
+        start = entity.offset
+        end = start + entity.length
+        if close_tag is None or end <= start or start >= text_length:
             continue
-        elif entity.type == "bold":
-            tag = "b"
-        elif entity.type == "italic":
-            tag = "i"
-        elif entity.type == "strikethrough":
-            tag = "s"
-        elif entity.type == "underline":
-            tag = "u"
-        elif entity.type == "code":
-            tag = "code"
-        elif entity.type == "pre":
-            tag = "pre"
-        elif entity.type == "spoiler":
-            tag = "tg-spoiler"
-        else:
-            quote += message_text[start:start_next_entity]
+        if end > text_length:
+            end = text_length
+        if indices is not None:
+            start, end = indices[start], indices[end]
+            if start == end:
+                continue
+        if start < cursor:
+            return _render_overlapping(text, entities, indices, text_length, escape)
+
+        parts.append(escape(text[cursor:start]))
+        parts.append(_open_tag(entity))
+        parts.append(escape(text[start:end]))
+        parts.append(close_tag)
+        cursor = end
+
+    parts.append(escape(text[cursor:]))
+    return "".join(parts)
+
+
+# Sweeps over entity boundaries, closing and reopening inner entities whenever an
+# entity closes before them
+def _render_overlapping(
+    text: str,
+    entities: Sequence[MessageEntity],
+    indices: list[int] | None,
+    text_length: int,
+    escape: Callable[[str], str],
+) -> str:
+    rendered = sorted(
+        (
+            x
+            for x in entities
+            if x.type in ENTITY_TAGS and x.length > 0 and x.offset < text_length
+        ),
+        key=lambda x: (x.offset, -x.length),
+    )
+    spans: list[tuple[int, int, int]] = []
+    for ind, entity in enumerate(rendered):
+        start = entity.offset
+        end = min(entity.offset + entity.length, text_length)
+        if indices is not None:
+            start, end = indices[start], indices[end]
+            if start == end:
+                continue
+        spans.append((start, end, ind))
+
+    # At the same position closing comes first, inner entities close before outer ones
+    # and outer entities open before inner ones
+    events = [(start, ENTITY_OPEN, ind) for start, _, ind in spans]
+    events += [(end, ENTITY_CLOSE, -ind) for _, end, ind in spans]
+    events.sort()
+
+    parts: list[str] = []
+    cursor = 0
+    open_stack: list[int] = []
+    for position, kind, key in events:
+        if position > cursor:
+            parts.append(escape(text[cursor:position]))
+            cursor = position
+
+        if kind == ENTITY_OPEN:
+            parts.append(_open_tag(rendered[key]))
+            open_stack.append(key)
             continue
 
-        quote += f"<{tag}>{message_text[start:end]}</{tag}>{message_text[end:start_next_entity]}"
-    return quote
+        closing = -key
+        reopen: list[int] = []
+        while open_stack[-1] != closing:
+            inner = open_stack.pop()
+            parts.append(CLOSE_TAGS[rendered[inner].type])
+            reopen.append(inner)
+        open_stack.pop()
+        parts.append(CLOSE_TAGS[rendered[closing].type])
+        for inner in reversed(reopen):
+            parts.append(_open_tag(rendered[inner]))
+            open_stack.append(inner)
+
+    parts.append(escape(text[cursor:]))
+    return "".join(parts)
+
+
+# Quotes rendered before the text was escaped contain raw text between our tags.
+# Escapes it, so they compare equal to the same message rendered today.
+def escape_legacy_markup(text: str) -> str:
+    parts: list[str] = []
+    cursor = 0
+    for match in RENDERED_TAG_PATTERN.finditer(text):
+        parts.append(html.escape(text[cursor : match.start()], quote=False))
+        if match.group(1) is not None:
+            parts.append(f'<a href="{html.escape(match.group(1))}">')
+        else:
+            parts.append(match.group(0))
+        cursor = match.end()
+    parts.append(html.escape(text[cursor:], quote=False))
+    return "".join(parts)
+
+
+# Plain text of a rendered quote, for places that don't support HTML like polls
+def html_to_text(text: str) -> str:
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
 
 
 def get_message_url(group_id: int, message_id: int) -> str:
@@ -69,6 +212,22 @@ def rfc3339_to_datetime(timestamp: str) -> datetime:
     return datetime.fromisoformat(timestamp)
 
 
+def datetime_to_epoch(timestamp: datetime) -> int:
+    return int(timestamp.timestamp())
+
+
+def epoch_to_datetime(timestamp: int) -> datetime:
+    return datetime.fromtimestamp(timestamp).astimezone()
+
+
+def epoch_to_rfc3339(timestamp: int) -> str:
+    return datetime_to_rfc3339(epoch_to_datetime(timestamp))
+
+
+def rfc3339_to_epoch(timestamp: str) -> int:
+    return datetime_to_epoch(rfc3339_to_datetime(timestamp))
+
+
 def chunks(lst, chunk_size):
     for i in range(0, len(lst), chunk_size):
         yield lst[i : i + chunk_size]
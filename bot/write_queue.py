@@ -0,0 +1,103 @@
+import asyncio
+from dataclasses import dataclass
+from enum import Enum
+
+from db_handler import DBHandler, Quote, QuoteWithId
+
+MAX_BATCH_SIZE = 64
+MAX_PENDING_WRITES = 1024
+
+
+class WriteStatus(Enum):
+    SAVED = "saved"
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+
+
+@dataclass(slots=True)
+class WriteResult:
+    status: WriteStatus
+    # The stored quote, for duplicates the one that already existed
+    quote: QuoteWithId | None = None
+
+
+# Collects quotes from all chats and writes them in batches, so a burst of quotes
+# costs one dedup lookup, one embedding call and one upsert per batch.
+# Enqueueing blocks once MAX_PENDING_WRITES quotes are waiting.
+class QuoteWriteQueue:
+    def __init__(
+        self,
+        db_handler: DBHandler,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_pending: int = MAX_PENDING_WRITES,
+    ):
+        self.db_handler = db_handler
+        self.max_batch_size = max_batch_size
+        self.queue: asyncio.Queue[tuple[Quote, asyncio.Future]] = asyncio.Queue(
+            maxsize=max_pending
+        )
+        self.worker: asyncio.Task | None = None
+
+    def start(self):
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        await self.queue.join()
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+
+    # Returns a future for the result, so callers can keep feeding the queue
+    async def enqueue(self, quote: Quote) -> asyncio.Future[WriteResult]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((quote, future))
+        return future
+
+    async def submit(self, quote: Quote) -> WriteResult:
+        return await (await self.enqueue(quote))
+
+    async def _run(self):
+        while True:
+            # Take whatever piled up while the previous batch was being written
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                results = await asyncio.to_thread(
+                    self._write_batch, [quote for quote, _ in batch]
+                )
+            except Exception as e:
+                print(f"Failed to write batch of {len(batch)} quotes: {e}")
+                results = [WriteResult(WriteStatus.FAILED) for _ in batch]
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+                self.queue.task_done()
+
+    def _write_batch(self, quotes: list[Quote]) -> list[WriteResult]:
+        keys = [(x.account_id, x.quote_text) for x in quotes]
+        existing = self.db_handler.find_quotes(keys)
+
+        results: list[WriteResult | None] = [None] * len(quotes)
+        to_save: dict[tuple[int, str], int] = {}
+        for ind, key in enumerate(keys):
+            if key in existing:
+                results[ind] = WriteResult(WriteStatus.DUPLICATE, existing[key])
+            elif key not in to_save:
+                to_save[key] = ind
+
+        if len(to_save) == 0:
+            return results
+
+        saved = self.db_handler.save_quotes([quotes[ind] for ind in to_save.values()])
+        saved_by_key = dict(zip(to_save.keys(), saved))
+        for ind, key in enumerate(keys):
+            if results[ind] is not None:
+                continue
+            if to_save[key] == ind:
+                results[ind] = WriteResult(WriteStatus.SAVED, saved_by_key[key])
+            else:
+                results[ind] = WriteResult(WriteStatus.DUPLICATE, saved_by_key[key])
+        return results
@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+# Needs a running Qdrant, configured like the bot
+QDRANT_HOST = os.environ.get("QDRANT_HOST", "localhost")
+QDRANT_PORT = int(os.environ.get("QDRANT_PORT", 6333))
+QDRANT_GRPC_PORT = int(os.environ.get("QDRANT_GRPC_PORT", 6334))
+
+COLLECTION_NAME = "TransportBenchmark"
+VECTOR_SIZE = 384
+POINT_COUNT = 2000
+ROUNDS = 200
+SEARCH_LIMIT = 5
+SCROLL_LIMIT = 100
+ACCOUNT_COUNT = 20
+
+
+def random_vector(rng: np.random.Generator) -> list[float]:
+    return rng.standard_normal(VECTOR_SIZE).astype(np.float32).tolist()
+
+
+def random_point(rng: np.random.Generator) -> models.PointStruct:
+    return models.PointStruct(
+        id=str(uuid.uuid4()),
+        vector=random_vector(rng),
+        payload={"account_id": int(rng.integers(ACCOUNT_COUNT))},
+    )
+
+
+def account_filter(account_id: int) -> models.Filter:
+    return models.Filter(
+        must=[
+            models.FieldCondition(
+                key="account_id", match=models.MatchValue(value=account_id)
+            )
+        ]
+    )
+
+
+def fill_collection(client: QdrantClient, rng: np.random.Generator):
+    client.recreate_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config=models.VectorParams(
+            size=VECTOR_SIZE, distance=models.Distance.COSINE
+        ),
+    )
+    client.create_payload_index(
+        collection_name=COLLECTION_NAME,
+        field_name="account_id",
+        field_schema=models.PayloadSchemaType.INTEGER,
+    )
+    for _ in range(POINT_COUNT // 500):
+        client.upsert(
+            collection_name=COLLECTION_NAME,
+            points=[random_point(rng) for _ in range(500)],
+        )
+
+
+# The mix the bot produces: filtered searches, per user scrolls and single upserts
+def run_mix(client: QdrantClient, rng: np.random.Generator) -> dict[str, float]:
+    timings = {"search": 0.0, "scroll": 0.0, "upsert": 0.0}
+    for _ in range(ROUNDS):
+        account_id = int(rng.integers(ACCOUNT_COUNT))
+        vector = random_vector(rng)
+        point = random_point(rng)
+
+        started = time.perf_counter()
+        client.search(
+            collection_name=COLLECTION_NAME,
+            query_vector=vector,
+            query_filter=account_filter(account_id),
+            limit=SEARCH_LIMIT,
+        )
+        timings["search"] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        client.scroll(
+            collection_name=COLLECTION_NAME,
+            scroll_filter=account_filter(account_id),
+            with_payload=True,
+            with_vectors=True,
+            limit=SCROLL_LIMIT,
+        )
+        timings["scroll"] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        client.upsert(collection_name=COLLECTION_NAME, points=[point])
+        timings["upsert"] += time.perf_counter() - started
+    return {k: v / ROUNDS for k, v in timings.items()}
+
+
+if __name__ == "__main__":
+    clients = {
+        transport: QdrantClient(
+            host=QDRANT_HOST,
+            port=QDRANT_PORT,
+            grpc_port=QDRANT_GRPC_PORT,
+            prefer_grpc=transport == "grpc",
+        )
+        for transport in ["rest", "grpc"]
+    }
+    fill_collection(clients["rest"], np.random.default_rng(0))
+    try:
+        for transport, client in clients.items():
+            # Warms up connections and caches before measuring
+            run_mix(client, np.random.default_rng(1))
+            timings = run_mix(client, np.random.default_rng(2))
+            print(
+                f"{transport:>4}: "
+                + ", ".join(f"{k} {v * 1e3:6.2f}ms" for k, v in timings.items())
+            )
+    finally:
+        clients["rest"].delete_collection(collection_name=COLLECTION_NAME)
@@ -0,0 +1,45 @@
+import os
+import sys
+import timeit
+
+from telegram import MessageEntity
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+from legacy_renderer import legacy_render  # noqa: E402
+from utils import render_entities  # noqa: E402
+
+REPEATS = 5
+NUMBER = 200
+
+
+# A long message with a formatted word every few words, the old renderer's worst case
+def formatted_message(words: int) -> tuple[str, list[MessageEntity]]:
+    types = ["bold", "italic", "code", "underline", "mention"]
+    parts = []
+    entities = []
+    offset = 0
+    for ind in range(words):
+        word = f"word{ind}"
+        if ind % 3 == 0:
+            entities.append(MessageEntity(types[ind % len(types)], offset, len(word)))
+        parts.append(word)
+        offset += len(word) + 1
+    return " ".join(parts), entities
+
+
+def best_of(func, text: str, entities: list[MessageEntity]) -> float:
+    timings = timeit.repeat(lambda: func(text, entities), repeat=REPEATS, number=NUMBER)
+    return min(timings) / NUMBER
+
+
+if __name__ == "__main__":
+    for words in [10, 100, 1000]:
+        text, entities = formatted_message(words)
+        legacy = best_of(legacy_render, text, entities)
+        current = best_of(render_entities, text, entities)
+        print(
+            f"{words:>5} words, {len(entities):>4} entities: "
+            f"legacy {legacy * 1e6:9.1f}us, render_entities {current * 1e6:9.1f}us "
+            f"({legacy / current:.1f}x)"
+        )
@@ -0,0 +1,57 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+from text_embedder import TextEmbedder  # noqa: E402
+
+# Downloads the model into ./models on the first run, like the bot
+QUOTE_COUNT = 256
+LONG_QUOTE_SHARE = 0.2
+REPEATS = 3
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "<b>quoted</b>", "&amp;", "ok"]
+
+
+def random_quote(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+# Mostly short quotes with some long forwards mixed in, stored as Telegram HTML
+def quote_mix(rng: random.Random) -> list[str]:
+    return [
+        random_quote(
+            rng, rng.randint(300, 600) if rng.random() < LONG_QUOTE_SHARE else 12
+        )
+        for _ in range(QUOTE_COUNT)
+    ]
+
+
+def best_of(func, data: list[str]) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    embedder = TextEmbedder()
+    data = quote_mix(random.Random(0))
+    chunk_count = sum(len(embedder.chunk(x)) for x in data)
+    # Warms up the model before measuring
+    embedder.embed(data[:16])
+
+    runs = {
+        # What was stored before chunking: raw HTML, truncated by the model
+        "encode raw HTML": embedder.model.encode,
+        "embed": embedder.embed,
+        "embed_chunked": embedder.embed_chunked,
+    }
+    print(f"{len(data)} quotes, {chunk_count} chunks")
+    for name, func in runs.items():
+        seconds = best_of(func, data)
+        print(f"{name:>16}: {seconds:6.2f}s, {len(data) / seconds:7.1f} quotes/s")
@@ -0,0 +1,44 @@
+from telegram import MessageEntity
+
+
+# The renderer sanitize_markdown used before render_entities, kept as a reference.
+# Only correct for sorted, non-overlapping entities on text without HTML characters.
+def legacy_render(message_text: str, entities: list[MessageEntity]) -> str:
+    if len(entities) == 0:
+        return message_text
+
+    # Guarantee that they are in the correct order
+    entities = sorted(entities, key=lambda x: x.offset)
+    quote = message_text[: entities[0].offset]
+    for i in range(len(entities)):
+        entity = entities[i]
+        start = entity.offset
+        end = entity.offset + entity.length
+        if i + 1 < len(entities):
+            start_next_entity = entities[i + 1].offset
+        else:
+            start_next_entity = None
+
+        if entity.type == "text_link":
+            quote += f'<a href="{entity.url}">{message_text[start:end]}</a>{message_text[end:start_next_entity]}'
+            continue
+        elif entity.type == "bold":
+            tag = "b"
+        elif entity.type == "italic":
+            tag = "i"
+        elif entity.type == "strikethrough":
+            tag = "s"
+        elif entity.type == "underline":
+            tag = "u"
+        elif entity.type == "code":
+            tag = "code"
+        elif entity.type == "pre":
+            tag = "pre"
+        elif entity.type == "spoiler":
+            tag = "tg-spoiler"
+        else:
+            quote += message_text[start:start_next_entity]
+            continue
+
+        quote += f"<{tag}>{message_text[start:end]}</{tag}>{message_text[end:start_next_entity]}"
+    return quote
@@ -0,0 +1,108 @@
+import numpy as np
+from hot_index import HotVectorIndex
+from qdrant_client import models
+
+
+def record(quote_id: str, text: str, *chunks: list[float]) -> models.Record:
+    return models.Record(
+        id=quote_id,
+        payload={"quote_text": text},
+        vector={f"chunk_{ind}": x for ind, x in enumerate(chunks)},
+    )
+
+
+def loaded_index(records: list[models.Record], **kwargs) -> HotVectorIndex:
+    index = HotVectorIndex(**kwargs)
+    index.put(1, records, index.generation(1))
+    return index
+
+
+def found_ids(index: HotVectorIndex, query: list[float], **kwargs) -> list[str]:
+    partition = index.get(1)
+    return [x.id for x in index.search(partition, np.array(query), limit=10, **kwargs)]
+
+
+def test_user_without_quotes_is_not_cached():
+    index = loaded_index([])
+    assert index.get(1) is None
+    assert index.used_bytes == 0
+
+
+def test_quote_scores_as_its_best_chunk():
+    index = loaded_index(
+        [
+            record("a", "a", [1, 0, 0], [0, 1, 0]),
+            record("b", "b", [0.8, 0.6, 0]),
+            record("c", "c", [0, 0, 1]),
+        ]
+    )
+    results = index.search(index.get(1), np.array([0, 2, 0]), limit=2)
+    assert [x.id for x in results] == ["a", "b"]
+    assert np.isclose(results[0].score, 1.0)
+    assert np.isclose(results[1].score, 0.6)
+
+
+def test_exclude_text_skips_matching_quotes():
+    index = loaded_index([record("a", "same", [1, 0]), record("b", "other", [0, 1])])
+    assert found_ids(index, [1, 0], exclude_text="same") == ["b"]
+
+
+def test_add_and_remove_keep_rows_owned_by_the_right_quote():
+    index = loaded_index(
+        [record("a", "a", [1, 0, 0], [0, 1, 0]), record("b", "b", [0, 0, 1])]
+    )
+    index.add(1, "c", {"quote_text": "c"}, np.array([[1, 1, 0], [0, 1, 1]]))
+    partition = index.get(1)
+    assert partition.owners.tolist() == [0, 0, 1, 2, 2]
+
+    index.remove(1, "a")
+    partition = index.get(1)
+    assert partition.ids == ["b", "c"]
+    assert partition.owners.tolist() == [0, 1, 1]
+    assert len(partition.vectors) == 3
+    assert index.used_bytes == partition.nbytes()
+    assert found_ids(index, [0, 0, 1]) == ["b", "c"]
+
+
+def test_add_replaces_a_quote_with_the_same_id():
+    index = loaded_index([record("a", "old", [1, 0])])
+    index.add(1, "a", {"quote_text": "new"}, np.array([[0, 1]]))
+    partition = index.get(1)
+    assert partition.ids == ["a"]
+    assert partition.payloads == [{"quote_text": "new"}]
+    assert partition.owners.tolist() == [0]
+
+
+def test_least_recently_used_partition_is_evicted():
+    one_partition = loaded_index([record("a", "a", [1, 0])]).used_bytes
+    index = HotVectorIndex(max_bytes=2 * one_partition)
+    for account_id in [1, 2]:
+        index.put(account_id, [record("a", "a", [1, 0])], index.generation(account_id))
+    index.get(1)
+    index.put(3, [record("a", "a", [1, 0])], index.generation(3))
+    assert list(index.partitions) == [1, 3]
+    assert index.used_bytes == 2 * one_partition
+
+
+def test_too_many_quotes_mark_user_oversized():
+    index = loaded_index(
+        [record(str(x), str(x), [1, 0]) for x in range(3)], max_partition_size=2
+    )
+    assert index.get(1) is None
+    assert index.is_oversized(1)
+
+
+def test_records_loaded_during_a_change_are_discarded():
+    index = HotVectorIndex()
+    generation = index.generation(1)
+    index.remove(1, "a")
+    index.put(1, [record("a", "a", [1, 0])], generation)
+    assert index.get(1) is None
+
+    generation = index.generation(1)
+    index.clear()
+    index.put(1, [record("a", "a", [1, 0])], generation)
+    assert index.get(1) is None
+
+    index.put(1, [record("a", "a", [1, 0])], index.generation(1))
+    assert index.get(1) is not None
@@ -0,0 +1,162 @@
+import httpx
+import pytest
+import qdrant_guard
+from pydantic import BaseModel, ValidationError
+from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+from qdrant_guard import (
+    FAILURE_THRESHOLD,
+    MAX_RETRIES,
+    OPERATION_DEADLINES,
+    CircuitBreaker,
+    DBUnavailableError,
+    GuardedClient,
+    is_unavailable,
+)
+
+
+# Stands in for QdrantClient, every call pops the next outcome
+class FakeClient:
+    def __init__(self, deadline: int, outcomes: list):
+        self.deadline = deadline
+        self.outcomes = outcomes
+        self.calls = 0
+
+    def _next(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 0 else "ok"
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def search(self):
+        return self._next()
+
+    def upsert(self):
+        return self._next()
+
+    def get_collections(self):
+        return self._next()
+
+
+def guarded(outcomes: list) -> tuple[GuardedClient, dict[int, FakeClient]]:
+    created: dict[int, FakeClient] = {}
+
+    def create_client(deadline: int) -> FakeClient:
+        created[deadline] = FakeClient(deadline, outcomes)
+        return created[deadline]
+
+    return GuardedClient(create_client), created
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(qdrant_guard, "RETRY_BASE_DELAY_SECONDS", 0)
+
+
+def validation_error() -> ValidationError:
+    class Model(BaseModel):
+        value: int
+
+    try:
+        Model(value="nope")
+    except ValidationError as e:
+        return e
+
+
+def unexpected_response(status_code: int) -> UnexpectedResponse:
+    return UnexpectedResponse(status_code, "", b"", httpx.Headers())
+
+
+def test_only_outages_count_as_unavailable():
+    assert is_unavailable(unexpected_response(503))
+    assert is_unavailable(ResponseHandlingException(httpx.ConnectError("refused")))
+    assert is_unavailable(TimeoutError())
+    assert is_unavailable(ConnectionRefusedError())
+    assert not is_unavailable(unexpected_response(400))
+    assert not is_unavailable(ResponseHandlingException(validation_error()))
+    assert not is_unavailable(FileNotFoundError())
+    assert not is_unavailable(ValueError())
+
+
+def test_calls_use_the_deadline_of_their_operation():
+    client, created = guarded([])
+    assert client.search() == "ok"
+    assert list(created) == [OPERATION_DEADLINES["search"]]
+
+
+def test_reads_are_retried_and_count_one_failure():
+    client, created = guarded([TimeoutError()] * (MAX_RETRIES + 1))
+    with pytest.raises(DBUnavailableError):
+        client.search()
+    assert created[OPERATION_DEADLINES["search"]].calls == MAX_RETRIES + 1
+    assert client.breaker.consecutive_failures == 1
+
+
+def test_retry_that_succeeds_resets_failures():
+    client, _ = guarded([TimeoutError()])
+    client.breaker.consecutive_failures = 1
+    assert client.search() == "ok"
+    assert client.breaker.consecutive_failures == 0
+
+
+def test_writes_are_not_retried():
+    client, created = guarded([TimeoutError()])
+    with pytest.raises(DBUnavailableError):
+        client.upsert()
+    assert created[OPERATION_DEADLINES["upsert"]].calls == 1
+
+
+def test_request_errors_pass_through_without_failures():
+    client, created = guarded([unexpected_response(400)])
+    with pytest.raises(UnexpectedResponse):
+        client.search()
+    assert created[OPERATION_DEADLINES["search"]].calls == 1
+    assert client.breaker.consecutive_failures == 0
+
+
+def test_open_breaker_fails_fast_until_probe_succeeds():
+    client, created = guarded([TimeoutError()] * FAILURE_THRESHOLD)
+    for _ in range(FAILURE_THRESHOLD):
+        with pytest.raises(DBUnavailableError):
+            client.upsert()
+    assert client.breaker.is_open
+
+    with pytest.raises(DBUnavailableError):
+        client.upsert()
+    assert created[OPERATION_DEADLINES["upsert"]].calls == FAILURE_THRESHOLD
+
+    assert client.probe()
+    assert not client.breaker.is_open
+    assert client.upsert() == "ok"
+
+
+def test_failed_probe_keeps_breaker_open():
+    client, _ = guarded([TimeoutError()])
+    client.breaker.is_open = True
+    assert not client.probe()
+    assert client.breaker.is_open
+
+
+def test_run_guards_requests_outside_the_client():
+    client, _ = guarded([])
+    deadlines = []
+    assert client.run("download_snapshot", lambda x: deadlines.append(x) or "ok")
+    assert deadlines == [OPERATION_DEADLINES["download_snapshot"]]
+
+    def fail(deadline: int):
+        raise TimeoutError()
+
+    with pytest.raises(DBUnavailableError):
+        client.run("download_snapshot", fail)
+    assert client.breaker.consecutive_failures == 1
+
+
+def test_breaker_opens_at_threshold():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(DBUnavailableError):
+        breaker.check()
+    breaker.close()
+    breaker.check()
@@ -0,0 +1,152 @@
+import random
+import re
+from datetime import datetime
+
+from legacy_renderer import legacy_render
+from telegram import Chat, Message, MessageEntity
+from utils import (
+    ENTITY_TAGS,
+    escape_legacy_markup,
+    html_to_text,
+    render_entities,
+    sanitize_markdown,
+)
+
+# Random cases per property, seeded so failures can be reproduced
+RUNS = 500
+
+# Types the renderer ignores are mixed in, they must leave the text alone
+ENTITY_TYPES = list(ENTITY_TAGS) + ["mention", "hashtag"]
+
+TAG_PATTERN = re.compile(r"<(/?)([a-z-]+)[^>]*>")
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def random_text(rng: random.Random, alphabet: str, max_length: int = 40) -> str:
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_length)))
+
+
+def random_entity(
+    rng: random.Random, offset: int, length: int, url: str
+) -> MessageEntity:
+    entity_type = rng.choice(ENTITY_TYPES)
+    return MessageEntity(
+        entity_type, offset, length, url=url if entity_type == "text_link" else None
+    )
+
+
+# Sorted entities that neither overlap nor nest, the only case the old renderer handled
+def disjoint_entities(
+    rng: random.Random, text_length: int, url: str
+) -> list[MessageEntity]:
+    count = rng.randint(0, min(4, text_length // 2))
+    bounds = sorted(rng.sample(range(text_length + 1), k=2 * count))
+    return [
+        random_entity(rng, start, end - start, url)
+        for start, end in zip(bounds[::2], bounds[1::2])
+    ]
+
+
+# Anything goes, including entities reaching past the end of the text
+def arbitrary_entities(
+    rng: random.Random, text_length: int, url: str
+) -> list[MessageEntity]:
+    return [
+        random_entity(
+            rng, rng.randint(0, text_length), rng.randint(0, text_length + 2), url
+        )
+        for _ in range(rng.randint(0, 6))
+    ]
+
+
+def is_well_nested(rendered: str) -> bool:
+    open_tags = []
+    for match in TAG_PATTERN.finditer(rendered):
+        if not match.group(1):
+            open_tags.append(match.group(2))
+        elif len(open_tags) == 0 or open_tags.pop() != match.group(2):
+            return False
+    return len(open_tags) == 0
+
+
+def test_matches_legacy_renderer_on_plain_cases():
+    rng = random.Random(0)
+    for _ in range(RUNS):
+        text = random_text(rng, "abc xyz")
+        entities = disjoint_entities(rng, len(text), "https://example.com/quote")
+        assert render_entities(text, entities) == legacy_render(text, entities)
+
+
+def test_text_survives_rendering():
+    rng = random.Random(1)
+    for _ in range(RUNS):
+        text = random_text(rng, "ab <>&\"'\né😀")
+        entities = arbitrary_entities(rng, utf16_length(text), "https://a.b/?c=1&d=2")
+        assert html_to_text(render_entities(text, entities)) == text
+
+
+def test_output_is_well_nested():
+    rng = random.Random(2)
+    for _ in range(RUNS):
+        text = random_text(rng, "ab <>&😀")
+        entities = arbitrary_entities(rng, utf16_length(text), "https://a.b")
+        assert is_well_nested(render_entities(text, entities))
+
+
+def test_legacy_quotes_are_escaped_like_new_ones():
+    rng = random.Random(3)
+    for _ in range(RUNS):
+        # The old renderer sliced code points, so only compare text without surrogates
+        text = random_text(rng, "xyz <>&é")
+        entities = disjoint_entities(rng, len(text), "https://a.b/?c=1&d=2")
+        assert escape_legacy_markup(legacy_render(text, entities)) == render_entities(
+            text, entities
+        )
+
+
+def test_offsets_count_utf16_code_units():
+    text = "😀 bold"
+    entities = [MessageEntity("bold", 3, 4)]
+    assert render_entities(text, entities) == "😀 <b>bold</b>"
+
+
+def test_overlapping_entities_are_closed_and_reopened():
+    entities = [MessageEntity("bold", 0, 4), MessageEntity("italic", 2, 4)]
+    assert render_entities("abcdef", entities) == "<b>ab<i>cd</i></b><i>ef</i>"
+
+
+def test_nested_entities():
+    entities = [MessageEntity("italic", 2, 2), MessageEntity("bold", 0, 6)]
+    assert render_entities("abcdef", entities) == "<b>ab<i>cd</i>ef</b>"
+
+
+def test_plain_text_is_escaped():
+    assert render_entities("Tom & Jerry <3", []) == "Tom &amp; Jerry &lt;3"
+
+
+def test_link_urls_are_escaped():
+    entities = [MessageEntity("text_link", 0, 4, url='https://a.b/?c=1&d="2"')]
+    assert (
+        render_entities("link", entities)
+        == '<a href="https://a.b/?c=1&amp;d=&quot;2&quot;">link</a>'
+    )
+
+
+def test_sanitize_markdown_renders_caption_and_hides_mentions():
+    message = Message(
+        message_id=1,
+        date=datetime.now(),
+        chat=Chat(id=-100123, type=Chat.SUPERGROUP),
+        caption="hey @you",
+        caption_entities=[MessageEntity("bold", 0, 3)],
+    )
+    assert sanitize_markdown(message) is None
+    assert sanitize_markdown(message, use_caption=True) == "<b>hey</b> ＠you"
+
+
+def test_unsorted_entities_render_like_sorted_ones():
+    entities = [MessageEntity("italic", 4, 2), MessageEntity("bold", 0, 2)]
+    assert render_entities("abcdef", entities) == "<b>ab</b>cd<i>ef</i>"